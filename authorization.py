@@ -1,24 +1,45 @@
+import asyncio
+import hashlib
 import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Annotated
+from typing import Annotated, Optional
 
 from fastapi import Depends, HTTPException, Header
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
 from passlib.context import CryptContext
 from pydantic import BaseModel
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
 from models import User
+from utils.outbox import enqueue_email
+from utils.telemetry import password_hash_seconds
 
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
 import secrets
 
 SECRET_KEY = os.getenv('SECRET_KEY')
 ALGORITHM = os.getenv('ALGORITHM')
 
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12'))
+HASH_WORKERS = int(os.getenv('HASH_WORKERS', str(os.cpu_count() or 1)))
+HASH_QUEUE_LIMIT = int(os.getenv('HASH_QUEUE_LIMIT', '64'))  # running + waiting hash jobs per worker process
+
+# min and max pinned to the work factor so hashes made with any other factor are rehashed on login
+pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto', bcrypt__default_rounds=BCRYPT_ROUNDS,
+                           bcrypt__min_rounds=BCRYPT_ROUNDS, bcrypt__max_rounds=BCRYPT_ROUNDS)
+# bcrypt releases the GIL, threads are enough to use every core
+hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='bcrypt')
+hash_stats = {'pending': 0, 'completed': 0, 'rejected': 0, 'rehashed': 0, 'seconds': 0.0}
+
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', '10000'))
+# sha256 of the token -> (claims, exp as a unix timestamp), least recently used first
+_token_cache: OrderedDict[bytes, tuple[dict, float]] = OrderedDict()
+token_cache_stats = {'hits': 0, 'misses': 0}
 oauth2_bearer = OAuth2PasswordBearer(tokenUrl='auth/token')
 internal_auth_token = os.getenv('INTERNAL_AUTH_TOKEN')
 
@@ -43,16 +64,46 @@ def hash_password(password: str) -> str:
     return pwd_context.hash(password)
 
 
-def verify_password(password: str, hashed_pass: str) -> bool:
-    return pwd_context.verify(password, hashed_pass)
+async def _run_hashing(fn, *args):
+    if hash_stats['pending'] >= HASH_QUEUE_LIMIT:
+        hash_stats['rejected'] += 1
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail='Too many concurrent password operations, try again later',
+                            headers={'Retry-After': '1'})
+
+    hash_stats['pending'] += 1
+    started = time.perf_counter()
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(hash_executor, fn, *args)
+        hash_stats['completed'] += 1
+        return result
+    finally:
+        hash_stats['pending'] -= 1
+        elapsed = time.perf_counter() - started
+        hash_stats['seconds'] += elapsed
+        password_hash_seconds.observe(elapsed)
+
+
+async def hash_password_async(password: str) -> str:
+    return await _run_hashing(hash_password, password)
+
+
+async def verify_password_async(password: str, hashed_pass: str) -> tuple[bool, Optional[str]]:
+    # the second item is a replacement hash when the stored one uses another work factor
+    return await _run_hashing(pwd_context.verify_and_update, password, hashed_pass)
 
 
-def authenticate_user(username: str, password: str, db):
-    user = db.query(User).filter(User.username == username).first()
+async def authenticate_user(username: str, password: str, db: AsyncSession):
+    user = await db.scalar(select(User).where(User.username == username))
     if not user:
         return False
-    if not verify_password(password, user.password_hash):
+    verified, new_hash = await verify_password_async(password, user.password_hash)
+    if not verified:
         return False
+    if new_hash is not None:
+        user.password_hash = new_hash
+        await db.commit()
+        hash_stats['rehashed'] += 1
     return user
 
 
@@ -63,7 +114,26 @@ def create_access_token(username: str, user_id: int, expires_delta: timedelta):
     return jwt.encode(encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
+def _cached_claims(key: bytes) -> Optional[dict]:
+    cached = _token_cache.get(key)
+    if cached is None:
+        return None
+    claims, expires = cached
+    if time.time() >= expires:
+        del _token_cache[key]
+        return None
+    _token_cache.move_to_end(key)
+    return dict(claims)
+
+
 async def validate_jwt(token: Annotated[str, Depends(oauth2_bearer)]):
+    key = hashlib.sha256(token.encode()).digest()
+    claims = _cached_claims(key)
+    if claims is not None:
+        token_cache_stats['hits'] += 1
+        return claims
+
+    token_cache_stats['misses'] += 1
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username = payload.get('sub')
@@ -71,7 +141,12 @@ async def validate_jwt(token: Annotated[str, Depends(oauth2_bearer)]):
         if username is None or user_id is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                                 detail='Could not validate credentials')
-        return {'username': username, 'id': user_id}
+        claims = {'username': username, 'id': user_id}
+        if payload.get('exp') is not None:
+            _token_cache[key] = (claims, float(payload['exp']))
+            if len(_token_cache) > TOKEN_CACHE_SIZE:
+                _token_cache.popitem(last=False)
+        return dict(claims)
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail='Could not validate user')
@@ -107,35 +182,22 @@ def validate_email(email: str):
     return True
 
 
-def get_user_by_email(email: str, db):
-    return db.query(User).filter(User.email == email).first()
+async def get_user_by_email(email: str, db: AsyncSession):
+    return await db.scalar(select(User).where(User.email == email))
 
 
 def generate_reset_code():
     return secrets.token_hex(8)
 
 
-def send_email(to_email: str, reset_code: str):
-    message = Mail(
-        from_email=os.getenv('FROM_EMAIL'),
-        to_emails=to_email,
-        subject='Password reset',
-        html_content=f'<strong>Reset code: {reset_code}</strong>'
-    )
-    
-    try:
-        sg = SendGridAPIClient(os.getenv('SENDGRID_API_KEY'))
-        response = sg.send(message)
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f'Error sending email: {e}'
-        )
-
-def update_password(email: str, new_password: str, db):
-    user = db.query(User).filter(User.email == email).first()
+async def send_email(to_email: str, reset_code: str, db: AsyncSession):
+    # delivery happens in utils.outbox.email_worker, the request only waits for the insert
+    await enqueue_email(db, to_email, 'Password reset', f'<strong>Reset code: {reset_code}</strong>')
+
+async def update_password(email: str, new_password: str, db: AsyncSession):
+    user = await db.scalar(select(User).where(User.email == email))
     if user:
-        user.password_hash = hash_password(new_password)
-        db.commit()
+        user.password_hash = await hash_password_async(new_password)
+        await db.commit()
         return True
     return False
@@ -0,0 +1,62 @@
+# In-process latency of every route, driven through the ASGI app without sockets.
+#
+#   python -m benchmarks.endpoints [--iterations 200] [--only user.companies auth] [--save-baseline | --check]
+#
+# Runs against a throwaway SQLite database and the fake Influx query API from benchmarks.harness,
+# each scenario is called sequentially so the numbers are per-request cost, not throughput under load.
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.harness import (configure_environment, install_fake_influx, AsgiClient, seed, select_scenarios,
+                                Timings, timed_call, summarize, print_report, save_baseline, check_baseline)
+
+PROFILE = "endpoints"
+
+
+async def run(args) -> dict[str, dict]:
+    import main
+    install_fake_influx(main.app, args.candle_seconds)
+
+    results = {}
+    async with main.lifespan(main.app):
+        session = await seed(AsgiClient(main.app), args.transactions)
+        for scenario in select_scenarios(args.only):
+            iterations = max(1, args.iterations // 10) if scenario.slow else args.iterations
+            for _ in range(args.warmup):
+                await timed_call(scenario, session, Timings())
+            timings = Timings()
+            started = time.perf_counter()
+            for _ in range(iterations):
+                await timed_call(scenario, session, timings)
+            results[scenario.name] = summarize(timings, time.perf_counter() - started)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--transactions", type=int, default=200, help="seeded for the benchmark user")
+    parser.add_argument("--candle-seconds", type=int, default=3600, help="spacing of the generated candles")
+    parser.add_argument("--only", nargs="+", help="scenario or router names")
+    parser.add_argument("--workdir", type=Path, default=Path(tempfile.gettempdir()) / "backend-benchmarks")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true", help="compare against the saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    configure_environment(args.workdir)
+    results = asyncio.run(run(args))
+    print_report(f"in-process, {args.iterations} iterations per scenario", results)
+    if args.save_baseline:
+        print(f"baseline written to {save_baseline(PROFILE, results, vars(args) | {'workdir': None})}")
+    if args.check and not check_baseline(PROFILE, results, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+# Shared pieces of the endpoint benchmarks: a local environment (SQLite + a fake Influx query
+# API serving generated candles), in-process and HTTP clients with the same interface, the
+# scenario mix covering every router, latency summaries and baseline files.
+import asyncio
+import json
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+from urllib.parse import urlencode, urlsplit
+
+import numpy as np
+import pandas as pd
+
+BASELINE_DIR = Path(__file__).parent / "baselines"
+SYMBOLS = [f"BN{i:02d}" for i in range(20)]
+PORTFOLIO = SYMBOLS[:5]
+INTERNAL_TOKEN = "benchmark"
+USER = {"username": "benchuser", "password": "benchpass123", "email": "bench@example.com"}
+
+
+def configure_environment(workdir: Path):
+    # has to run before the app is imported, database.py and friends read their settings on import
+    workdir.mkdir(parents=True, exist_ok=True)
+    db = workdir / "benchmark.db"
+    for path in workdir.glob("benchmark.db*"):
+        path.unlink()
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{db}",
+        "ASYNC_DATABASE_URL": f"sqlite+aiosqlite:///{db}",
+        "INTERNAL_AUTH_TOKEN": INTERNAL_TOKEN,
+        "EMAIL_TRANSPORT": "file",
+        "EMAIL_FILE_DIR": str(workdir / "mail"),
+        "PROFILE_DIR": str(workdir / "profiles"),
+        # the pool client is never used, requests get the fake query API
+        "INFUX_URL": "http://127.0.0.1:9",
+    })
+    defaults = {
+        "SECRET_KEY": "benchmark",
+        "ALGORITHM": "HS256",
+        "INFUX_BUCKET": "benchmark",
+        # every request comes from one address and user, throttling would only measure 429s and 503s
+        "LOGIN_IP_RATE": "1000000",
+        "LOGIN_IP_BURST": "1000000",
+        "LOGIN_USER_RATE": "1000000",
+        "LOGIN_USER_BURST": "1000000",
+        "LOGIN_MAX_INFLIGHT": "1000000",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+
+
+class FakeQueryApi:
+    # Answers the Flux queries InfluxClient builds with deterministic candles, so the real query
+    # building, candle cache and post-processing run while the data never leaves the process.
+
+    def __init__(self, symbols: list[str], candle_seconds: int = 3600):
+        self.symbols = symbols
+        self.candle_seconds = candle_seconds
+
+    def query_api(self):
+        return self
+
+    async def query_data_frame(self, query: str) -> pd.DataFrame:
+        start, stop = (pd.Timestamp(value) for value in re.findall(r"(?:start|stop): (\S+?)[,)]", query))
+        if "last()" in query:
+            return self._latest(stop)
+        symbol = re.search(r'r\.Symbol == "([^"]*)"', query)
+        symbols = [symbol.group(1)] if symbol else self.symbols
+        window = re.search(r"aggregateWindow\(every: (\d+)s", query)
+        step = int(window.group(1)) if window else self.candle_seconds
+        frames = [self._candles(name, start, stop, step) for name in symbols if name in self.symbols]
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+    def _candles(self, symbol: str, start: pd.Timestamp, stop: pd.Timestamp, step: int) -> pd.DataFrame:
+        first = int(np.ceil(start.timestamp() / step)) * step
+        seconds = np.arange(first, stop.timestamp(), step, dtype=np.int64)
+        close = self._price(symbol, seconds)
+        spread = close * 0.01
+        return pd.DataFrame({
+            "_time": pd.to_datetime(seconds, unit="s", utc=True),
+            "Symbol": symbol,
+            "OpenPrice": close - spread / 2,
+            "HighPrice": close + spread,
+            "LowPrice": close - spread,
+            "ClosePrice": close,
+            "Volume": (seconds % 997) + 100,
+        })
+
+    def _latest(self, stop: pd.Timestamp) -> pd.DataFrame:
+        seconds = np.array([int(stop.timestamp()) // self.candle_seconds * self.candle_seconds], dtype=np.int64)
+        return pd.DataFrame({
+            "Symbol": self.symbols,
+            "_time": pd.to_datetime(np.repeat(seconds, len(self.symbols)), unit="s", utc=True),
+            "ClosePrice": [float(self._price(symbol, seconds)[0]) for symbol in self.symbols],
+        })
+
+    def _price(self, symbol: str, seconds: np.ndarray) -> np.ndarray:
+        # a pure function of symbol and time, so overlapping windows agree with each other
+        seed = sum(map(ord, symbol))
+        days = seconds / 86400
+        noise = np.modf(np.sin(seconds * 1e-3 + seed) * 43758.5453)[0]
+        return 50 + seed % 150 + 10 * np.sin(days / 9 + seed) + 3 * np.sin(days * 1.7 + seed / 3) + noise
+
+
+def install_fake_influx(app, candle_seconds: int = 3600):
+    from database import InfluxClient, get_influx_client
+
+    api = FakeQueryApi(SYMBOLS, candle_seconds)
+
+    async def fake_influx_client():
+        return InfluxClient.from_pool(api, bucket=os.environ["INFUX_BUCKET"])
+
+    app.dependency_overrides[get_influx_client] = fake_influx_client
+
+
+Response = tuple[int, bytes]
+
+
+class AsgiClient:
+    # drives the app in-process without sockets, requests go through the full middleware stack
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method: str, url: str, headers: Optional[dict] = None, json_body=None,
+                      form: Optional[dict] = None) -> Response:
+        body, headers = _encode_body(headers, json_body, form)
+        parts = urlsplit(url)
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": parts.path,
+            "raw_path": parts.path.encode(),
+            "query_string": parts.query.encode(),
+            "root_path": "",
+            "headers": [(key.lower().encode(), value.encode()) for key, value in headers.items()],
+            "client": ("127.0.0.1", 50000),
+            "server": ("benchmark", 80),
+        }
+        done = asyncio.Event()
+        sent = False
+        status = 500
+        chunks = []
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # streaming responses listen for a disconnect, only report one once the body is out
+            await done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    done.set()
+
+        await self.app(scope, receive, send)
+        done.set()
+        return status, b"".join(chunks)
+
+
+class HttpClient:
+
+    def __init__(self, base_url: str, session):
+        self.base_url = base_url
+        self.session = session
+
+    async def request(self, method: str, url: str, headers: Optional[dict] = None, json_body=None,
+                      form: Optional[dict] = None) -> Response:
+        body, headers = _encode_body(headers, json_body, form)
+        async with self.session.request(method, self.base_url + url, headers=headers, data=body) as response:
+            return response.status, await response.read()
+
+
+def _encode_body(headers: Optional[dict], json_body, form: Optional[dict]) -> tuple[bytes, dict]:
+    headers = dict(headers or {})
+    if json_body is not None:
+        headers["Content-Type"] = "application/json"
+        return json.dumps(json_body).encode(), headers
+    if form is not None:
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+        return urlencode(form).encode(), headers
+    return b"", headers
+
+
+@dataclass
+class Session:
+    # what the scenarios need to know about the seeded data
+    client: object
+    internal_token: str = INTERNAL_TOKEN
+    token: str = ""
+    company_ids: list[int] = field(default_factory=list)
+    counter: int = 0
+
+    @property
+    def user_headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.token}"}
+
+    @property
+    def internal_headers(self) -> dict:
+        return {"Authorization": self.internal_token}
+
+    def next_id(self) -> int:
+        self.counter += 1
+        return self.counter
+
+
+async def seed(client, transactions: int = 200, internal_token: str = INTERNAL_TOKEN) -> Session:
+    # writes BN* companies, the benchmark user and its transactions into whatever the client points at
+    session = Session(client, internal_token)
+    companies = [{"name": f"Benchmark {symbol}", "symbol": symbol} for symbol in SYMBOLS]
+    await _expect(client.request("POST", "/append_companies", session.internal_headers,
+                                 json_body={"companies": companies}), 201)
+    # 400 when a previous run against the same database already registered the user
+    await _expect(client.request("POST", "/auth/register", json_body=USER), 201, 400)
+    session.token = json.loads(await _expect(client.request(
+        "POST", "/auth/token", form={"username": USER["username"], "password": USER["password"]}
+    ), 200))["access_token"]
+    listed = json.loads(await _expect(client.request("GET", "/companies"), 200))["companies"]
+    session.company_ids = [company["id"] for company in listed if company["symbol"] in PORTFOLIO]
+    for i in range(transactions):
+        await _expect(client.request("PUT", "/user/transaction", session.user_headers, json_body={
+            "amount": 1 + i % 7,
+            "price_per_unit": 10 + i % 13,
+            "transaction_date": f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}",
+            "transaction_type": "SELL" if i % 5 == 4 else "BUY",
+            "company_id": session.company_ids[i % len(session.company_ids)],
+        }), 200)
+    return session
+
+
+async def _expect(response: Awaitable[Response], *statuses: int) -> bytes:
+    code, body = await response
+    if code not in statuses:
+        raise RuntimeError(f"Seeding failed with {code}: {body[:200]!r}")
+    return body
+
+
+@dataclass
+class Scenario:
+    name: str
+    router: str
+    run: Callable[[Session], Awaitable[Response]]
+    expected: int = 200
+    weight: int = 1  # share of the HTTP load mix
+    slow: bool = False  # bcrypt bound, run fewer in-process iterations
+    hot: bool = False  # regressions fail --check, the others only warn
+
+
+def _simulator_body() -> dict:
+    return {"companies": [{"company_symbol": symbol, "investment_volume": 1000 * (i + 1)}
+                          for i, symbol in enumerate(PORTFOLIO)]}
+
+
+def _register(s: Session):
+    n = s.next_id()
+    return s.client.request("POST", "/auth/register", json_body={
+        "username": f"u{os.getpid()}x{n}"[-20:], "password": "benchpass123", "email": f"u{os.getpid()}x{n}@example.com"
+    })
+
+
+SCENARIOS = [
+    Scenario("auth.register", "auth", _register, expected=201, slow=True),
+    Scenario("auth.token", "auth", lambda s: s.client.request(
+        "POST", "/auth/token", form={"username": USER["username"], "password": USER["password"]}), slow=True),
+    Scenario("auth.forgot_password", "auth", lambda s: s.client.request(
+        "POST", "/auth/forgot_password", json_body={"email": USER["email"]})),
+    Scenario("me", "me", lambda s: s.client.request("GET", "/me", s.user_headers), weight=5),
+    Scenario("user.companies", "user", lambda s: s.client.request("GET", "/companies"), weight=10, hot=True),
+    Scenario("user.company", "user", lambda s: s.client.request(
+        "GET", f"/company?id={s.company_ids[0]}"), weight=5, hot=True),
+    Scenario("user.candlestick", "user", lambda s: s.client.request(
+        "GET", f"/company/chart/candlestick?company={PORTFOLIO[0]}&range=7d"), weight=5, hot=True),
+    Scenario("user.simulator", "user", lambda s: s.client.request(
+        "POST", "/simulator", json_body=_simulator_body()), weight=5, hot=True),
+    Scenario("user.scenarios", "user", lambda s: s.client.request(
+        "POST", "/simulator/scenarios?paths=2000&horizon=21", json_body=_simulator_body()), weight=2, hot=True),
+    Scenario("user.wallet", "user", lambda s: s.client.request("GET", "/user/wallet", s.user_headers),
+             weight=5, hot=True),
+    Scenario("user.transactions", "user", lambda s: s.client.request(
+        "GET", "/user/transactions?limit=50", s.user_headers), weight=5),
+    Scenario("user.add_transaction", "user", lambda s: s.client.request(
+        "PUT", "/user/transaction", s.user_headers, json_body={
+            "amount": 1, "price_per_unit": 10, "transaction_date": "2024-06-01", "transaction_type": "BUY",
+            "company_id": s.company_ids[s.next_id() % len(s.company_ids)]}), weight=2),
+    Scenario("user.export", "user", lambda s: s.client.request(
+        "GET", "/user/transactions/export?format=csv", s.user_headers)),
+    Scenario("internal.append_companies", "internal", lambda s: s.client.request(
+        "POST", "/append_companies", s.internal_headers, json_body={
+            "companies": [{"name": f"Benchmark {symbol}", "symbol": symbol} for symbol in SYMBOLS]}), expected=201),
+    Scenario("internal.stats", "internal", lambda s: s.client.request("GET", "/stats", s.internal_headers)),
+    Scenario("internal.metrics", "internal", lambda s: s.client.request("GET", "/metrics", s.internal_headers)),
+]
+
+
+def select_scenarios(names: Optional[list[str]]) -> list[Scenario]:
+    if not names:
+        return SCENARIOS
+    selected = [scenario for scenario in SCENARIOS
+                if scenario.name in names or scenario.router in names]
+    if not selected:
+        raise SystemExit(f"No scenario matches {names}, pick from {[s.name for s in SCENARIOS]}")
+    return selected
+
+
+@dataclass
+class Timings:
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+
+
+async def timed_call(scenario: Scenario, session: Session, timings: Timings):
+    started = time.perf_counter()
+    try:
+        status, _ = await scenario.run(session)
+    except Exception:
+        status = None
+    timings.latencies.append(time.perf_counter() - started)
+    if status != scenario.expected:
+        timings.errors += 1
+
+
+def summarize(timings: Timings, elapsed: float) -> dict:
+    latencies = np.array(timings.latencies) * 1000
+    if not len(latencies):
+        return {"count": 0, "errors": timings.errors, "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "rps": 0.0}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "count": len(latencies),
+        "errors": timings.errors,
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "rps": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+    }
+
+
+def print_report(title: str, results: dict[str, dict]):
+    print(title)
+    print(f"{'scenario':<28} {'count':>7} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9}")
+    for name, row in results.items():
+        print(f"{name:<28} {row['count']:>7} {row['errors']:>6} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} "
+              f"{row['p99_ms']:>9.2f} {row['rps']:>9.1f}")
+
+
+def save_baseline(profile: str, results: dict[str, dict], settings: dict) -> Path:
+    BASELINE_DIR.mkdir(parents=True, exist_ok=True)
+    path = BASELINE_DIR / f"{profile}.json"
+    path.write_text(json.dumps({"settings": settings, "results": results}, indent=2) + "\n")
+    return path
+
+
+def check_baseline(profile: str, results: dict[str, dict], tolerance: float) -> bool:
+    # a scenario regresses when p95 grows or throughput drops by more than the tolerance,
+    # only hot scenarios fail the check, numbers from other machines are not comparable
+    path = BASELINE_DIR / f"{profile}.json"
+    if not path.exists():
+        print(f"No baseline at {path}, run with --save-baseline first")
+        return False
+    baseline = json.loads(path.read_text())["results"]
+    hot = {scenario.name for scenario in SCENARIOS if scenario.hot}
+    passed = True
+    for name, row in results.items():
+        if name not in baseline or not baseline[name]["count"]:
+            continue
+        before = baseline[name]
+        problems = []
+        if row["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            problems.append(f"p95 {before['p95_ms']:.2f} -> {row['p95_ms']:.2f} ms")
+        if row["rps"] < before["rps"] * (1 - tolerance):
+            problems.append(f"req/s {before['rps']:.1f} -> {row['rps']:.1f}")
+        if row["errors"] > before["errors"]:
+            problems.append(f"errors {before['errors']} -> {row['errors']}")
+        if problems:
+            level = "REGRESSION" if name in hot else "warning"
+            print(f"{level}: {name}: {', '.join(problems)}")
+            passed = passed and name not in hot
+    print("baseline check " + ("passed" if passed else "failed"))
+    return passed
@@ -0,0 +1,117 @@
+# HTTP load profile over a weighted mix of every route.
+#
+#   python -m benchmarks.load [--concurrency 32] [--duration 30] [--save-baseline | --check]
+#   python -m benchmarks.load --url http://staging:8000 --internal-token $INTERNAL_AUTH_TOKEN
+#
+# Without --url the app is started under uvicorn with benchmarks.server (SQLite + fake Influx),
+# seeded over HTTP, and hit by --concurrency clients for --duration seconds after a warm-up.
+# With --url the target is seeded the same way: it gets BN* companies, a benchmark user and its
+# transactions written into its real database, and every scenario including registrations and
+# password reset emails runs against it. Never point it at production.
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+
+from benchmarks.harness import (INTERNAL_TOKEN, HttpClient, seed, select_scenarios, Timings, timed_call, summarize, print_report,
+                                save_baseline, check_baseline)
+
+PROFILE = "load"
+
+
+def start_server(args) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, "-m", "benchmarks.server", "--port", str(args.port),
+                             "--candle-seconds", str(args.candle_seconds), "--workdir", str(args.workdir)])
+
+
+async def wait_until_ready(session: aiohttp.ClientSession, url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(url + "/docs") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+
+
+async def drive(scenarios, session, timings: dict[str, Timings], duration: float, concurrency: int, seed_value: int):
+    deadline = time.perf_counter() + duration
+    weights = [scenario.weight for scenario in scenarios]
+
+    async def worker(n: int):
+        rng = random.Random(seed_value + n)
+        while time.perf_counter() < deadline:
+            scenario = rng.choices(scenarios, weights)[0]
+            await timed_call(scenario, session, timings.setdefault(scenario.name, Timings()))
+
+    await asyncio.gather(*(worker(n) for n in range(concurrency)))
+
+
+async def run(args) -> dict[str, dict]:
+    url = args.url or f"http://127.0.0.1:{args.port}"
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as http:
+        await wait_until_ready(http, url)
+        session = await seed(HttpClient(url, http), args.transactions, args.internal_token)
+        scenarios = select_scenarios(args.only)
+
+        await drive(scenarios, session, {}, args.warmup, args.concurrency, args.seed)
+        timings: dict[str, Timings] = {}
+        started = time.perf_counter()
+        await drive(scenarios, session, timings, args.duration, args.concurrency, args.seed)
+        elapsed = time.perf_counter() - started
+
+    results = {name: summarize(timings[name], elapsed) for name in sorted(timings)}
+    total = Timings([latency for t in timings.values() for latency in t.latencies],
+                    sum(t.errors for t in timings.values()))
+    results["total"] = summarize(total, elapsed)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=30, help="seconds measured")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds run before measuring")
+    parser.add_argument("--seed", type=int, default=0, help="makes the request mix reproducible")
+    parser.add_argument("--transactions", type=int, default=200, help="seeded for the benchmark user")
+    parser.add_argument("--candle-seconds", type=int, default=3600, help="spacing of the generated candles")
+    parser.add_argument("--only", nargs="+", help="scenario or router names")
+    parser.add_argument("--url", help="benchmark a running app instead of starting one, writes seed data into it")
+    parser.add_argument("--internal-token", default=os.getenv("BENCHMARK_INTERNAL_TOKEN", INTERNAL_TOKEN),
+                        help="INTERNAL_AUTH_TOKEN of the --url app, defaults to $BENCHMARK_INTERNAL_TOKEN")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workdir", type=Path, default=Path(tempfile.gettempdir()) / "backend-benchmarks-load")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true", help="compare against the saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    server = None if args.url else start_server(args)
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print_report(f"HTTP load, {args.concurrency} clients for {args.duration:.0f}s", results)
+    if args.save_baseline:
+        settings = vars(args) | {"workdir": None, "internal_token": None}
+        print(f"baseline written to {save_baseline(PROFILE, results, settings)}")
+    if args.check and not check_baseline(PROFILE, results, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
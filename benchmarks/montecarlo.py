@@ -0,0 +1,60 @@
+# Paths per second per core of the /simulator/scenarios engine.
+#
+#   python -m benchmarks.montecarlo [--paths 50000] [--horizon 21] [--symbols 5 20 100]
+#
+# Runs simulate_portfolio on one core, then the same workload spread over the process pool,
+# with a synthetic covariance matrix so no database or Influx is needed.
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from utils.montecarlo import simulate_portfolio, MONTE_CARLO_WORKERS
+
+
+def synthetic_portfolio(symbols: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    returns = rng.normal(0.05, 1.5, size=(250, symbols))
+    weights = rng.random(symbols)
+    return returns.mean(axis=0), np.atleast_2d(np.cov(returns, rowvar=False)), weights / weights.sum()
+
+
+def bench_single(symbols: int, paths: int, horizon: int) -> float:
+    mean, covariance, weights = synthetic_portfolio(symbols)
+    started = time.perf_counter()
+    result = simulate_portfolio(mean, covariance, weights, paths, horizon, cpu_budget=float("inf"))
+    return result["paths"] / (time.perf_counter() - started)
+
+
+def bench_pool(symbols: int, paths: int, horizon: int, workers: int) -> float:
+    mean, covariance, weights = synthetic_portfolio(symbols)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # warm the workers up so process start-up is not measured
+        list(executor.map(simulate_portfolio, *zip(*[(mean, covariance, weights, 100, horizon)] * workers)))
+        started = time.perf_counter()
+        futures = [executor.submit(simulate_portfolio, mean, covariance, weights, paths, horizon, float("inf"))
+                   for _ in range(workers)]
+        done = sum(future.result()["paths"] for future in futures)
+    return done / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--paths", type=int, default=50000)
+    parser.add_argument("--horizon", type=int, default=21)
+    parser.add_argument("--symbols", type=int, nargs="+", default=[5, 20, 100])
+    parser.add_argument("--workers", type=int, default=MONTE_CARLO_WORKERS)
+    args = parser.parse_args()
+
+    print(f"horizon={args.horizon} paths={args.paths} workers={args.workers} cpus={os.cpu_count()}")
+    print(f"{'symbols':>8} {'1 core paths/s':>16} {'pool paths/s':>14} {'pool paths/s/core':>18}")
+    for symbols in args.symbols:
+        single = bench_single(symbols, args.paths, args.horizon)
+        pool = bench_pool(symbols, args.paths, args.horizon, args.workers)
+        print(f"{symbols:>8} {single:>16,.0f} {pool:>14,.0f} {pool / args.workers:>18,.0f}")
+
+
+if __name__ == "__main__":
+    main()
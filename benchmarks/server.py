@@ -0,0 +1,28 @@
+# The app behind uvicorn with the benchmark environment, started by benchmarks.load.
+#
+#   python -m benchmarks.server [--port 8765] [--workdir /tmp/backend-benchmarks]
+import argparse
+import tempfile
+from pathlib import Path
+
+import uvicorn
+
+from benchmarks.harness import configure_environment, install_fake_influx
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--candle-seconds", type=int, default=3600)
+    parser.add_argument("--workdir", type=Path, default=Path(tempfile.gettempdir()) / "backend-benchmarks")
+    args = parser.parse_args()
+
+    configure_environment(args.workdir)
+    import main as app_module
+    install_fake_influx(app_module.app, args.candle_seconds)
+    uvicorn.run(app_module.app, host=args.host, port=args.port, log_level="warning", access_log=False)
+
+
+if __name__ == "__main__":
+    main()
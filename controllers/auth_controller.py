@@ -1,25 +1,26 @@
 from datetime import datetime, timedelta
 from typing import Annotated
 
-from fastapi import Depends, HTTPException, APIRouter, Form
+from fastapi import Depends, HTTPException, APIRouter, Form, Request
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
 import authorization
-from authorization import CreateUserRequest, hash_password, Token, authenticate_user, \
+from authorization import CreateUserRequest, hash_password_async, Token, authenticate_user, \
     create_access_token, ResetPasswordRequest, ResetPasswordResponse, generate_reset_code, \
     get_user_by_email, send_email, update_password
 from models import User
 from utils.utils import get_db
+from utils.reset_codes import reset_codes
+from utils.throttle import check_login, client_address, login_slot
 
 router = APIRouter(
     prefix='/auth',
     tags=['auth']
 )
 
-db_dependency = Annotated[Session, Depends(get_db)]
-password_reset_codes = {}
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
 @router.post('/register', status_code=status.HTTP_201_CREATED)
 async def register(db: db_dependency,
@@ -36,21 +37,23 @@ async def register(db: db_dependency,
 
     create_user_model = User(
         username=create_user_request.username,
-        password_hash=hash_password(create_user_request.password),
+        password_hash=await hash_password_async(create_user_request.password),
         email=create_user_request.email,
         last_login_date=datetime.now()
     )
 
     db.add(create_user_model)
-    db.commit()
+    await db.commit()
 
     return {'message': 'User registered successfully'}
 
 
 @router.post('/token', response_model=Token)
 async def login_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-                             db: db_dependency):
-    user = authenticate_user(form_data.username, form_data.password, db)
+                             db: db_dependency, request: Request):
+    check_login(form_data.username, client_address(request))
+    async with login_slot():
+        user = await authenticate_user(form_data.username, form_data.password, db)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail='Could not validate credentials')
@@ -60,14 +63,14 @@ async def login_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Dep
 
 
 @router.post("/forgot_password", response_model=ResetPasswordResponse)
-async def forgot_password(request: ResetPasswordRequest, db: Session = Depends(get_db)):
-    user = get_user_by_email(request.email, db)
+async def forgot_password(request: ResetPasswordRequest, db: AsyncSession = Depends(get_db)):
+    user = await get_user_by_email(request.email, db)
     if user:
         reset_code = generate_reset_code()
 
-        password_reset_codes[reset_code] = request.email
+        await reset_codes.put(reset_code, request.email)
 
-        send_email(request.email, reset_code)
+        await send_email(request.email, reset_code, db)
 
         return {"message": "Password reset instructions sent to your email."}
     else:
@@ -77,12 +80,10 @@ async def forgot_password(request: ResetPasswordRequest, db: Session = Depends(g
         )
         
 @router.post("/reset_password", response_model=ResetPasswordResponse)
-async def reset_password(code: str = Form(...), new_password: str = Form(...), db: Session = Depends(get_db)):
-    email = password_reset_codes.get(code)
+async def reset_password(code: str = Form(...), new_password: str = Form(...), db: AsyncSession = Depends(get_db)):
+    email = await reset_codes.pop(code)
     if email:
-        update_password(email, new_password, db)
-
-        del password_reset_codes[code]
+        await update_password(email, new_password, db)
 
         return {"message": "Password reset successful."}
     else:
@@ -1,21 +1,29 @@
-from typing import Annotated
+from datetime import datetime
+from typing import Annotated, Literal
 
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException, Response
+from fastapi.responses import FileResponse, PlainTextResponse
 from fastapi.params import Depends
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
-from models import Company
+from utils.companies import upsert_companies
+from utils.directory import bump_version, refresh_directory
 from utils.utils import get_db
-from authorization import validate_internal_auth
+from authorization import validate_internal_auth, hash_stats, token_cache_stats
+from database import candle_cache
+from utils.outbox import outbox_stats
+from utils.throttle import login_stats
+from utils.telemetry import render_metrics
+from utils.profiler import list_profiles, profile_path, render_profile
 
 router = APIRouter(
     tags=['internal'],
     dependencies=[Depends(validate_internal_auth)]
 )
 
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
 
 class CompanyModel(BaseModel):
@@ -31,23 +39,64 @@ class InternalResponse(BaseModel):
     status: str
 
 
+class AppendCompaniesResponse(InternalResponse):
+    inserted: int
+    updated: int
+    unchanged: int
+    conflicts: int  # names already used by another symbol, left untouched
+
+
+class ProfileModel(BaseModel):
+    name: str
+    size: int
+    created: datetime
+
+
 # todo: add authentication
-@router.post('/append_companies', status_code=status.HTTP_201_CREATED, response_model=InternalResponse)
+@router.post('/append_companies', status_code=status.HTTP_201_CREATED, response_model=AppendCompaniesResponse)
 async def append_companies(db: db_dependency,
                            company_list: CompanyListModel):
     # auth_header = request.headers.get('Authorization')
     # if auth_header is not internal_auth_token:
     #     return {'status': 'failed'}
 
-    companies = []
-    for company in company_list.companies:
-        company = Company(
-            company_name=company.name,
-            company_symbol=company.symbol
-        )
-        companies.append(company)
+    counts = await upsert_companies(db, [(company.name, company.symbol) for company in company_list.companies])
+    if counts['inserted'] or counts['updated']:
+        await bump_version(db)
+        await refresh_directory(db)
+
+    return {'status': 'success', **counts}
+
+
+@router.get('/stats', status_code=status.HTTP_200_OK)
+async def get_stats():
+    return {
+        'password_hashing': hash_stats,
+        'token_cache': token_cache_stats,
+        'candle_cache': candle_cache.stats(),
+        'email_outbox': outbox_stats,
+        'login_throttle': login_stats
+    }
+
+
+@router.get('/metrics', status_code=status.HTTP_200_OK)
+async def get_metrics():
+    body, content_type = render_metrics()
+    # passed as a header, media_type would append a second charset to the exposition format's type
+    return Response(content=body, headers={'Content-Type': content_type})
+
+
+@router.get('/profiles', response_model=list[ProfileModel], status_code=status.HTTP_200_OK)
+async def get_profiles():
+    return list_profiles()
 
-    db.add_all(companies)
-    db.commit()
 
-    return {'status': 'success'}
+@router.get('/profiles/{name}', status_code=status.HTTP_200_OK)
+async def get_profile(name: str, format: Literal["prof", "text"] = "prof"):
+    path = profile_path(name)
+    if path is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+    if format == "text":
+        return PlainTextResponse(render_profile(path))
+    # pstats dump, load with pstats.Stats or snakeviz
+    return FileResponse(path, media_type="application/octet-stream", filename=name)
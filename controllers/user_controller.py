@@ -1,25 +1,39 @@
+import asyncio
+import base64
 from datetime import date, datetime
-from typing import Annotated, Optional, List
+from typing import Annotated, Optional, List, Literal
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Header, UploadFile
 from fastapi.params import Depends
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy import select, delete, update, or_, and_
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
+from starlette.responses import Response, StreamingResponse
 
 from authorization import validate_jwt
-from models import TransactionType, UserTransaction, Transaction, Company
+from models import TransactionType, UserTransaction, Transaction, Holding
 from utils.utils import get_db
-from database import get_influx_client
-from utils.metrics import get_metric
-
-db_dependency = Annotated[Session, Depends(get_db)]
+from utils.holdings import holding_delta, apply_holding_delta
+from utils.csv_import import import_transactions
+from utils.transaction_export import export_transactions, MEDIA_TYPES as EXPORT_MEDIA_TYPES
+from utils.directory import get_directory, refresh_directory
+from database import get_influx_client, InfluxClient, CANDLE_RESOLUTIONS
+from utils.metrics import get_metric, get_scenarios
+from utils.montecarlo import MONTE_CARLO_MAX_PATHS
+from utils.candles import negotiate_media_type, JSON_MEDIA_TYPE, ENCODERS, available_media_types
+
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 user_dependency = Annotated[dict, Depends(validate_jwt)]
+influx_dependency = Annotated[InfluxClient, Depends(get_influx_client)]
 
 router = APIRouter(
     tags=['user']
 )
 
+# how far back /companies looks for the last traded price of a symbol
+LATEST_PRICE_RANGE = "3d"
+
 
 class TransactionRequest(BaseModel):
     id: int
@@ -40,6 +54,19 @@ class TransactionModel(BaseModel):
 
 class TransactionListModel(BaseModel):
     transactions: list[TransactionModel]
+    next_cursor: Optional[str] = None  # pass back as ?cursor= for the next page, None on the last one
+
+
+class ImportErrorModel(BaseModel):
+    row: int  # data row in the file, the header is not counted
+    error: str
+
+
+class ImportResultModel(BaseModel):
+    imported: int
+    failed: int
+    errors: list[ImportErrorModel]
+    errors_truncated: bool
 
 
 class CompanyCandleStickModel(BaseModel):
@@ -83,6 +110,19 @@ class SimulatorResultModel(BaseModel):
     recommendation: str
 
 
+class ScenarioResultModel(BaseModel):
+    paths: int  # simulated paths, fewer than requested when the CPU budget ran out
+    horizon: int  # trading days
+    truncated: bool
+    cpu_seconds: float
+    expected_return: float  # percent over the horizon
+    percentiles: dict[str, float]
+    var_95: float  # value at risk, loss in percent
+    cvar_95: float  # expected loss beyond var_95
+    var_99: float
+    cvar_99: float
+
+
 class WalletModel(BaseModel):
     name: str
     amount: int
@@ -94,6 +134,32 @@ class CompanyByIdModel(BaseModel):
     id: int
 
 
+def parse_transaction_type(value: str) -> TransactionType:
+    try:
+        return TransactionType.parse(value)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+async def linked_user_ids(db: AsyncSession, transaction_id: int) -> list[int]:
+    return list(await db.scalars(
+        select(UserTransaction.user_id).where(UserTransaction.transaction_id == transaction_id)
+    ))
+
+
+def encode_cursor(transaction: Transaction) -> str:
+    key = f"{transaction.transaction_date.isoformat()}|{transaction.id}"
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[date, int]:
+    try:
+        cursor_date, cursor_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return date.fromisoformat(cursor_date), int(cursor_id)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
 @router.put('/user/transaction', status_code=status.HTTP_200_OK, response_model=TransactionResult)
 async def create_transaction(user: user_dependency, db: db_dependency, transaction_obj: TransactionModel):
     if user is None:
@@ -104,24 +170,29 @@ async def create_transaction(user: user_dependency, db: db_dependency, transacti
     if transaction_obj.id != 0:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Transaction id must be 0")
 
+    transaction_type = parse_transaction_type(transaction_obj.transaction_type)
+
     transaction = Transaction(
         amount=transaction_obj.amount,
         price_per_unit=transaction_obj.price_per_unit,
         transaction_date=transaction_obj.transaction_date,
-        transaction_type=transaction_obj.transaction_type,
+        transaction_type=transaction_type,
         company_id=transaction_obj.company_id
     )
 
     db.add(transaction)
-    db.commit()
+    await db.flush()
 
     user_transaction = UserTransaction(
         user_id=user_id,
-        transaction_id=transaction.id
+        transaction_id=transaction.id,
+        transaction_date=transaction.transaction_date
     )
 
     db.add(user_transaction)
-    db.commit()
+    await apply_holding_delta(db, [user_id], transaction.company_id,
+                              holding_delta(transaction_type, transaction.amount, transaction.price_per_unit))
+    await db.commit()
 
     return {'status': 'success'}
 
@@ -134,32 +205,29 @@ async def delete_transaction(user: user_dependency, db: db_dependency, token: Tr
     transaction_id = token.id
     user_id = user['id']
 
-    user_transaction = (
-        db.query(UserTransaction)
-        .filter(UserTransaction.transaction_id == transaction_id)
-        .filter(UserTransaction.user_id == user_id)
-        .filter(UserTransaction.transaction_id == transaction_id)
-        .first()
+    transaction = await db.scalar(
+        select(Transaction)
+        .join(UserTransaction)
+        .where(UserTransaction.transaction_id == transaction_id)
+        .where(UserTransaction.user_id == user_id)
+        .with_for_update()
     )
 
-    if user_transaction is None:
+    if transaction is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Transaction not found")
 
-    db.delete(user_transaction)
-    db.commit()
-
-    transaction = (
-        db.query(Transaction)
-        .filter(Transaction.id == transaction_id)
-        .first()
-    )
-
-    if transaction is None or user_transaction is None:
+    user_ids = await linked_user_ids(db, transaction_id)
+    # core deletes, the ORM would lazy load Transaction.users to unlink it first
+    await db.execute(delete(UserTransaction).where(UserTransaction.transaction_id == transaction_id))
+    result = await db.execute(delete(Transaction).where(Transaction.id == transaction_id))
+    if result.rowcount != 1:
+        # a concurrent delete got there first and already took it off the holdings
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Transaction not found")
 
-    db.delete(user_transaction)
-    db.delete(transaction)
-    db.commit()
+    await apply_holding_delta(db, user_ids, transaction.company_id,
+                              holding_delta(transaction.transaction_type, transaction.amount,
+                                            transaction.price_per_unit, sign=-1))
+    await db.commit()
 
     return {'status': 'success'}
 
@@ -171,52 +239,132 @@ async def update_transaction(user: user_dependency, db: db_dependency, transacti
 
     user_id = user['id']
 
-    transaction = (
-        db.query(Transaction)
+    transaction = await db.scalar(
+        select(Transaction)
         .join(UserTransaction)
-        .filter(UserTransaction.transaction_id == transaction_obj.id)
-        .filter(UserTransaction.user_id == user_id)
-        .first()
+        .where(UserTransaction.transaction_id == transaction_obj.id)
+        .where(UserTransaction.user_id == user_id)
+        .with_for_update()
     )
 
     if transaction is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Transaction not found")
 
+    transaction_type = parse_transaction_type(transaction_obj.transaction_type)
+    user_ids = await linked_user_ids(db, transaction.id)
+    await apply_holding_delta(db, user_ids, transaction.company_id,
+                              holding_delta(transaction.transaction_type, transaction.amount,
+                                            transaction.price_per_unit, sign=-1))
+
     transaction.amount = transaction_obj.amount
     transaction.price_per_unit = transaction_obj.price_per_unit
     transaction.transaction_date = transaction_obj.transaction_date
-    transaction.transaction_type = transaction_obj.transaction_type
+    transaction.transaction_type = transaction_type
     transaction.company_id = transaction_obj.company_id
+    await db.execute(update(UserTransaction)
+                     .where(UserTransaction.transaction_id == transaction.id)
+                     .values(transaction_date=transaction.transaction_date))
 
-    db.commit()
+    await apply_holding_delta(db, user_ids, transaction.company_id,
+                              holding_delta(transaction_type, transaction.amount, transaction.price_per_unit))
+    await db.commit()
 
     return {'status': 'success'}
 
 
 @router.get('/user/transactions', status_code=status.HTTP_200_OK, response_model=TransactionListModel)
-async def get_all_transactions(user: user_dependency, db: db_dependency):
+async def get_all_transactions(user: user_dependency, db: db_dependency,
+                               limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+                               cursor: Optional[str] = None,
+                               company_id: Optional[int] = None,
+                               transaction_type: Optional[str] = None,
+                               date_from: Optional[date] = None,
+                               date_to: Optional[date] = None):
     if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Authentication required")
 
     user_id = user['id']
 
-    transactions = (
-        db.query(Transaction)
+    # the range and order are on user_transaction so the page is read from ix_user_transaction_user_date,
+    # company and type filters are applied to the joined rows while walking it
+    query = (
+        select(Transaction)
         .join(UserTransaction)
-        .filter(UserTransaction.user_id == user_id)
-        .all()
+        .where(UserTransaction.user_id == user_id)
+        .order_by(UserTransaction.transaction_date.desc(), UserTransaction.transaction_id.desc())
+        .limit(limit + 1)
     )
+    if company_id is not None:
+        query = query.where(Transaction.company_id == company_id)
+    if transaction_type is not None:
+        query = query.where(Transaction.transaction_type == parse_transaction_type(transaction_type))
+    if date_from is not None:
+        query = query.where(UserTransaction.transaction_date >= date_from)
+    if date_to is not None:
+        query = query.where(UserTransaction.transaction_date <= date_to)
+    if cursor is not None:
+        cursor_date, cursor_id = decode_cursor(cursor)
+        query = query.where(or_(
+            UserTransaction.transaction_date < cursor_date,
+            and_(UserTransaction.transaction_date == cursor_date, UserTransaction.transaction_id < cursor_id)
+        ))
+
+    transactions = (await db.scalars(query)).all()
+
+    next_cursor = None
+    if len(transactions) > limit:
+        transactions = transactions[:limit]
+        next_cursor = encode_cursor(transactions[-1])
+
+    return {'transactions': transactions, 'next_cursor': next_cursor}
+
+
+@router.post('/user/transactions/import', status_code=status.HTTP_200_OK, response_model=ImportResultModel)
+async def import_user_transactions(user: user_dependency, db: db_dependency, file: UploadFile):
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Authentication required")
 
-    return {'transactions': transactions}
+    try:
+        return await import_transactions(db, user['id'], file)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+@router.get('/user/transactions/export', status_code=status.HTTP_200_OK)
+async def export_user_transactions(user: user_dependency, format: Literal["csv", "ndjson"] = "csv"):
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Authentication required")
+
+    return StreamingResponse(
+        export_transactions(user['id'], format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={'Content-Disposition': f'attachment; filename="transactions.{format}"'}
+    )
 
 
 @router.get('/company/chart/candlestick', status_code=status.HTTP_200_OK, response_model=CompanyCandleStickListModel)
-async def get_company_candle_chart(company: str = "XD", range: str = "7d"):
-    client = await get_influx_client()
-    data = await client.query_data(range, company)
+async def get_company_candle_chart(influx: influx_dependency, company: str = "XD", range: str = "7d",
+                                   resolution: Optional[str] = None,
+                                   max_points: Annotated[int, Query(ge=10, le=10000)] = 1000,
+                                   layout: Literal["rows", "columns"] = "rows",
+                                   accept: Annotated[Optional[str], Header()] = None):
+    if resolution is not None and resolution not in CANDLE_RESOLUTIONS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Resolution must be one of {', '.join(CANDLE_RESOLUTIONS)}")
+
+    media_type = negotiate_media_type(accept)
+    if media_type is None:
+        raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE,
+                            detail=f"Supported media types: {', '.join(available_media_types())}")
+
+    data = await influx.query_candles(range, company, resolution, max_points)
     if data is None or data.empty:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No data found for company")
 
+    # binary formats are always columnar, json stays row oriented unless asked otherwise
+    if media_type != JSON_MEDIA_TYPE or layout == "columns":
+        return Response(content=ENCODERS[media_type](data), media_type=media_type)
+
     records = []
     for index, row in data.iterrows():
         record = CompanyCandleStickModel(
@@ -233,59 +381,49 @@ async def get_company_candle_chart(company: str = "XD", range: str = "7d"):
 
 
 @router.get('/companies', status_code=status.HTTP_200_OK, response_model=CompanyListModel)
-async def get_all_companies(db: db_dependency):
-    companies = db.query(Company).all()
+async def get_all_companies(influx: influx_dependency):
+    companies = get_directory().frame.copy()
 
-    records = []
-    client = await get_influx_client()
-    data = await client.query_data("3d")
-
-    for company in companies:
-        price_per_unit = 0
-        for index, row in data.iterrows():
-            if row['Symbol'] == company.company_symbol:
-                price_per_unit = row['ClosePrice']
-                break
-
-        record = CompanyModel(
-            id=company.id,
-            name=company.company_name,
-            symbol=company.company_symbol,
-            price_per_unit=price_per_unit
-        )
-        records.append(record)
+    prices = await influx.query_latest(LATEST_PRICE_RANGE)
+    if prices is not None and not prices.empty:
+        latest = prices.drop_duplicates('Symbol', keep='last').set_index('Symbol')['ClosePrice']
+        companies['price_per_unit'] = companies['symbol'].map(latest).fillna(0)
+    else:
+        companies['price_per_unit'] = 0
 
-    return CompanyListModel(companies=records)
+    return CompanyListModel(companies=companies.to_dict('records'))
 
 
 @router.get('/company', status_code=status.HTTP_200_OK, response_model=CompanyModel)
-async def get_company_by_id(id: int, db: db_dependency):
-    company = db.query(Company).filter(Company.id == id).first()
+async def get_company_by_id(id: int, influx: influx_dependency):
+    company = get_directory().by_id.get(id)
 
     if company is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Company not found")
 
-    client = await get_influx_client()
-    data = await client.query_data("30d", company.company_symbol)
+    data = await influx.query_data("30d", company.symbol)
 
     if data is None or data.empty:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No data found for company")
 
     record = CompanyModel(
         id=company.id,
-        name=company.company_name,
-        symbol=company.company_symbol,
+        name=company.name,
+        symbol=company.symbol,
         price_per_unit=data.iloc[-1]['ClosePrice']
     )
     return record
 
 
 @router.post('/simulator', status_code=status.HTTP_200_OK, response_model=SimulatorResultModel)
-async def run_simulator(db: db_dependency, company_list: SimulatorCompanyListModel):
+async def run_simulator(influx: influx_dependency, company_list: SimulatorCompanyListModel):
     companies_values = {}
     for company in company_list.companies:
         companies_values[company.company_symbol] = company.investment_volume
-    result = await get_metric(companies_values)
+    try:
+        result = await get_metric(companies_values, influx)
+    except LookupError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
 
     return SimulatorResultModel(
         roi=result['ROI'],
@@ -296,6 +434,23 @@ async def run_simulator(db: db_dependency, company_list: SimulatorCompanyListMod
     )
 
 
+@router.post('/simulator/scenarios', status_code=status.HTTP_200_OK, response_model=ScenarioResultModel)
+async def run_scenarios(influx: influx_dependency, company_list: SimulatorCompanyListModel,
+                        paths: Annotated[int, Query(ge=100, le=MONTE_CARLO_MAX_PATHS)] = 10000,
+                        horizon: Annotated[int, Query(ge=1, le=252)] = 21):
+    companies_values = {}
+    for company in company_list.companies:
+        companies_values[company.company_symbol] = company.investment_volume
+    try:
+        result = await get_scenarios(companies_values, paths, horizon, influx)
+    except LookupError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Simulation timed out")
+
+    return ScenarioResultModel(horizon=horizon, **result)
+
+
 @router.get('/user/wallet', response_model=List[WalletModel], status_code=status.HTTP_200_OK)
 async def get_user_wallet(user: user_dependency, db: db_dependency):
     if user is None:
@@ -303,48 +458,33 @@ async def get_user_wallet(user: user_dependency, db: db_dependency):
 
     user_id = user['id']
 
-    user_transactions = (
-        db.query(UserTransaction)
-        .filter(UserTransaction.user_id == user_id)
-        .all()
-    )
+    holdings = (await db.scalars(
+        select(Holding)
+        .where(Holding.user_id == user_id)
+        .where(Holding.buy_amount + Holding.sell_amount > 0)
+        .order_by(Holding.company_id)
+    )).all()
 
-    user_portfolio = {}
-    for user_transaction in user_transactions:
-        transaction = user_transaction.transaction
-        company_name = transaction.company.company_name
-        amount = transaction.amount
-        price_per_unit = transaction.price_per_unit
-        transaction_type = transaction.transaction_type
-
-        if company_name not in user_portfolio:
-            user_portfolio[company_name] = {'total_amount': 0, 'total_cost': 0, 'total_buy_amount': 0,
-                                            'total_buy_cost': 0, 'total_sell_amount': 0, 'total_sell_cost': 0}
-
-        if transaction_type == TransactionType.BUY:
-            user_portfolio[company_name]['total_amount'] += amount
-            user_portfolio[company_name]['total_buy_amount'] += amount
-            user_portfolio[company_name]['total_buy_cost'] += amount * price_per_unit
-        elif transaction_type == TransactionType.SELL:
-            user_portfolio[company_name]['total_amount'] -= amount
-            user_portfolio[company_name]['total_sell_amount'] += amount
-            user_portfolio[company_name]['total_sell_cost'] += amount * price_per_unit
-            user_portfolio[company_name]['total_buy_amount'] -= amount
+    directory = get_directory()
+    if any(holding.company_id not in directory.by_id for holding in holdings):
+        # a company added through another worker that this one has not picked up yet
+        directory = await refresh_directory(db)
 
     wallet_records = []
-    for company_name, values in user_portfolio.items():
-        total_amount = values['total_amount']
-        total_buy_amount = values['total_buy_amount']
-        total_buy_cost = values['total_buy_cost']
-        total_sell_amount = values['total_sell_amount']
-        total_sell_cost = values['total_sell_cost']
+    for holding in holdings:
+        company = directory.by_id.get(holding.company_id)
+        company_name = company.name if company is not None else ''
+
+        # sells are taken off the bought amount, the buy price is averaged over what is still held
+        total_buy_amount = holding.amount
+        total_sell_amount = holding.sell_amount
 
-        average_buy_price = total_buy_cost / total_buy_amount if total_buy_amount > 0 else 0
-        average_sell_price = total_sell_cost / total_sell_amount if total_sell_amount > 0 else 0
+        average_buy_price = float(holding.buy_cost) / total_buy_amount if total_buy_amount > 0 else 0
+        average_sell_price = float(holding.sell_cost) / total_sell_amount if total_sell_amount > 0 else 0
 
         wallet_record = WalletModel(
             name=company_name,
-            amount=total_amount,
+            amount=holding.amount,
             average_buy_price=average_buy_price,
             average_sell_price=average_sell_price
         )
@@ -1,34 +1,109 @@
+import asyncio
 import datetime
 import logging
+import math
 import os
+import time
 from typing import Optional
 from datetime import datetime, timedelta
 
+import aiohttp
 import influxdb_client
 from dotenv import load_dotenv
 from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
 from pandas import DataFrame
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base, sessionmaker
 
+from utils.cache import TimeSeriesCache
+from utils.telemetry import influx_query_seconds, influx_rows, influx_errors, timed
+
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-database_url = f"mysql+pymysql://{os.getenv('MYSQL_USER')}:{os.getenv('MYSQL_PASSWORD')}@{os.getenv('MYSQL_HOST')}/{os.getenv('MYSQL_DB')}"
+mysql_location = f"{os.getenv('MYSQL_USER')}:{os.getenv('MYSQL_PASSWORD')}@{os.getenv('MYSQL_HOST')}/{os.getenv('MYSQL_DB')}"
+# DATABASE_URL / ASYNC_DATABASE_URL override MySQL, e.g. sqlite:///local.db and sqlite+aiosqlite:///local.db
+database_url = os.getenv('DATABASE_URL', f"mysql+pymysql://{mysql_location}")
+async_database_url = os.getenv('ASYNC_DATABASE_URL', f"mysql+aiomysql://{mysql_location}")
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '20'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))  # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))  # below MySQL's wait_timeout
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+
+
+def _pool_options(url: str) -> dict:
+    # sqlite uses a single-connection/null pool that takes no sizing arguments
+    if make_url(url).get_backend_name() == 'sqlite':
+        return {}
+    return {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+
+
+# the sync engine is left for scripts, request handlers use the async one
 engine = create_engine(database_url)
+async_engine = create_async_engine(async_database_url, **_pool_options(async_database_url))
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 
 # influx_client = influxdb_client.InfluxDBClient(url=os.getenv('INFUX_URL'), token=os.getenv('INFUX_TOKEN'),
 #                                                org=os.getenv('INFUX_ORG'), timeout=1000000)
 
+INFLUX_POOL_SIZE = int(os.getenv('INFUX_POOL_SIZE', '20'))
+INFLUX_TIMEOUT = float(os.getenv('INFUX_TIMEOUT', '30'))  # seconds, whole request
+INFLUX_CONNECT_TIMEOUT = float(os.getenv('INFUX_CONNECT_TIMEOUT', '5'))  # seconds
+INFLUX_KEEPALIVE = float(os.getenv('INFUX_KEEPALIVE', '60'))  # seconds an idle connection is kept open
+
+_influx_pool: Optional[InfluxDBClientAsync] = None
+
+# raw candles returned by InfluxClient.query_data, CANDLE_CACHE_MB=0 disables the cache
+candle_cache = TimeSeriesCache(max_bytes=int(float(os.getenv('CANDLE_CACHE_MB', '256')) * 1024 * 1024),
+                               ttl=float(os.getenv('CANDLE_CACHE_TTL', '60')))
+
+# query_latest snapshots by range string, only written by that query
+_latest_prices: dict[str, tuple[float, DataFrame]] = {}
+_latest_lock = asyncio.Lock()
+
+# candle widths the chart can be downsampled to, in seconds
+CANDLE_RESOLUTIONS = {
+    "1min": 60,
+    "5min": 5 * 60,
+    "15min": 15 * 60,
+    "30min": 30 * 60,
+    "1h": 60 * 60,
+    "4h": 4 * 60 * 60,
+    "1d": 24 * 60 * 60,
+    "1w": 7 * 24 * 60 * 60,
+}
+
+
+def _pooled_session(connector: aiohttp.TCPConnector, **kwargs) -> aiohttp.ClientSession:
+    # influxdb-client builds its own connector with only `limit` set, rebuild it so idle
+    # connections are kept alive between requests instead of being torn down.
+    connector = aiohttp.TCPConnector(
+        limit=INFLUX_POOL_SIZE,
+        keepalive_timeout=INFLUX_KEEPALIVE,
+        ssl=connector._ssl
+    )
+    return aiohttp.ClientSession(connector=connector, **kwargs)
+
 
 class InfluxClient:
     _client: InfluxDBClientAsync
     _bucket: str
+    _owns_client: bool = True
 
     @classmethod
     async def get_uploader(cls, url: str, token: str, org: str, bucket: str):
@@ -37,6 +112,14 @@ class InfluxClient:
         self._bucket = bucket
         return self
 
+    @classmethod
+    def from_pool(cls, client: InfluxDBClientAsync, bucket: str):
+        self = cls()
+        self._client = client
+        self._bucket = bucket
+        self._owns_client = False
+        return self
+
     def format_date(self, date: datetime) -> str:
         return date.strftime("%Y-%m-%dT%H:%M:%SZ")
 
@@ -79,16 +162,74 @@ class InfluxClient:
 
         formatted_range = self.get_dates_from_now(range_str)
 
-        query = self._get_query(formatted_range, symbol)
+        async def fetch(start: datetime, stop: datetime) -> Optional[DataFrame]:
+            return await self._query_frame(self._get_query((start, stop), symbol), 'raw')
+
+        return await candle_cache.get(symbol, *formatted_range, fetch)
+
+    async def query_candles(
+            self, range_str: str, symbol: str, resolution: Optional[str] = None, max_points: int = 1000
+    ) -> Optional[DataFrame]:
+
+        formatted_range = self.get_dates_from_now(range_str)
+        window = self.pick_window(formatted_range, max_points, resolution)
+        if window is None:
+            return await self.query_data(range_str, symbol)
+
+        async def fetch(start: datetime, stop: datetime) -> Optional[DataFrame]:
+            return await self._query_frame(self._get_candles_query((start, stop), symbol, window), 'candles')
+
+        # aggregateWindow aligns windows to the epoch, so a refresh starting at the last cached
+        # candle rebuilds that candle and appends the newer ones like it does for raw rows
+        return await candle_cache.get((symbol, window), *formatted_range, fetch)
+
+    def pick_window(
+            self, range: tuple[datetime, datetime], max_points: int, resolution: Optional[str] = None
+    ) -> Optional[int]:
+        # smallest candle width that keeps the range within max_points, an explicit resolution
+        # is only honoured while it does not exceed that bound
+        span = (range[1] - range[0]).total_seconds()
+        needed = span / max_points
+        if resolution is not None and CANDLE_RESOLUTIONS[resolution] >= needed:
+            return CANDLE_RESOLUTIONS[resolution]
+        if resolution is None and needed <= CANDLE_RESOLUTIONS["1min"]:
+            return None
+        for width in CANDLE_RESOLUTIONS.values():
+            if width >= needed:
+                return width
+        return math.ceil(needed)
+
+    async def query_latest(self, range_str: str = "3d") -> Optional[DataFrame]:
+        # one snapshot across all symbols, kept for the candle cache TTL instead of going through it
+        cached = _fresh_latest(range_str)
+        if cached is not None:
+            return cached
+
+        async with _latest_lock:
+            cached = _fresh_latest(range_str)
+            if cached is not None:
+                return cached
+            formatted_range = self.get_dates_from_now(range_str)
+            query = self._get_latest_query(formatted_range)
+            df = await self._query_frame(query, 'latest')
+            if isinstance(df, DataFrame) and not df.empty:
+                _latest_prices[range_str] = (time.monotonic(), df)
+            return df
+
+    async def _query_frame(self, query: str, kind: str = 'raw') -> Optional[DataFrame]:
         api = self._client.query_api()
         try:
-            df: DataFrame = await api.query_data_frame(query)
+            with timed(influx_query_seconds, kind=kind):
+                df: DataFrame = await api.query_data_frame(query)
 
         except Exception as e:
             logger.error(f"Failed to query data. Reason: {e}")
+            influx_errors.labels(kind).inc()
             return None
         finally:
-            await self._client.close()
+            if self._owns_client:
+                await self._client.close()
+        influx_rows.labels(kind).inc(len(df))
         return df
 
     def _get_query(self, range=tuple[datetime, datetime], symbol: Optional[str] = None) -> str:
@@ -100,11 +241,85 @@ class InfluxClient:
                             """
         return f"""from(bucket: "{self._bucket}")
                             |> range(start: {self.format_date(range[0])}, stop: {self.format_date(range[1])})
-                            |> filter(fn: (r) => r._measurement == "CandleData" and r.Symbol == "{symbol}")
+                            |> filter(fn: (r) => r._measurement == "CandleData" and r.Symbol == "{flux_escape(symbol)}")
+                            |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")
+                            """
+
+    def _get_candles_query(self, range=tuple[datetime, datetime], symbol: str = "", window: int = 60) -> str:
+        aggregate = f'aggregateWindow(every: {window}s, fn: {{fn}}, createEmpty: false, timeSrc: "_start")'
+        fields = [("OpenPrice", "first"), ("HighPrice", "max"), ("LowPrice", "min"), ("ClosePrice", "last"),
+                  ("Volume", "sum")]
+        tables = ",\n                            ".join(
+            f'data |> filter(fn: (r) => r._field == "{field}") |> {aggregate.format(fn=fn)}' for field, fn in fields
+        )
+        return f"""data = from(bucket: "{self._bucket}")
+                            |> range(start: {self.format_date(range[0])}, stop: {self.format_date(range[1])})
+                            |> filter(fn: (r) => r._measurement == "CandleData" and r.Symbol == "{flux_escape(symbol)}")
+
+                        union(tables: [
+                            {tables}
+                        ])
                             |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")
+                            |> sort(columns: ["_time"])
+                            """
+
+    def _get_latest_query(self, range=tuple[datetime, datetime]) -> str:
+        # last() per series is pushed down to the storage engine, the max over _time only
+        # merges series that share a symbol
+        return f"""from(bucket: "{self._bucket}")
+                            |> range(start: {self.format_date(range[0])}, stop: {self.format_date(range[1])})
+                            |> filter(fn: (r) => r._measurement == "CandleData" and r._field == "ClosePrice")
+                            |> last()
+                            |> group(columns: ["Symbol"])
+                            |> max(column: "_time")
+                            |> group()
+                            |> keep(columns: ["Symbol", "_time", "_value"])
+                            |> rename(columns: {{_value: "ClosePrice"}})
                             """
 
 
+def _fresh_latest(range_str: str) -> Optional[DataFrame]:
+    cached = _latest_prices.get(range_str)
+    if cached is None or candle_cache.max_bytes <= 0 or time.monotonic() - cached[0] > candle_cache.ttl:
+        return None
+    return cached[1]
+
+
+def flux_escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+async def open_influx_pool():
+    global _influx_pool
+    if _influx_pool is None:
+        _influx_pool = InfluxDBClientAsync(
+            url=os.getenv('INFUX_URL'), token=os.getenv('INFUX_TOKEN'), org=os.getenv('INFUX_ORG'),
+            enable_gzip=True,
+            timeout=aiohttp.ClientTimeout(total=INFLUX_TIMEOUT, connect=INFLUX_CONNECT_TIMEOUT),
+            connection_pool_maxsize=INFLUX_POOL_SIZE,
+            client_session_type=_pooled_session
+        )
+    return _influx_pool
+
+
+async def close_influx_pool():
+    global _influx_pool
+    if _influx_pool is not None:
+        await _influx_pool.close()
+        _influx_pool = None
+
+
+def influx_pool_usage() -> Optional[tuple[int, int]]:
+    # (connections in use, limit) of the shared client, None outside of the app lifespan
+    if _influx_pool is None or _influx_pool.api_client is None:
+        return None
+    connector = _influx_pool.api_client.rest_client.pool_manager.connector
+    return len(connector._acquired), connector.limit
+
+
 async def get_influx_client():
+    if _influx_pool is not None:
+        return InfluxClient.from_pool(_influx_pool, bucket=os.getenv('INFUX_BUCKET'))
+    # outside of the app lifespan (scripts, shell) fall back to a one-shot client
     return await InfluxClient.get_uploader(url=os.getenv('INFUX_URL'), token=os.getenv('INFUX_TOKEN'),
                               org=os.getenv('INFUX_ORG'), bucket=os.getenv('INFUX_BUCKET'))
@@ -1,17 +1,50 @@
+import asyncio
+from contextlib import asynccontextmanager
 from typing import Annotated
 
 import uvicorn
 from fastapi import FastAPI, HTTPException, Depends, status
-from sqlalchemy.orm import Session
 from starlette.middleware.cors import CORSMiddleware
 
 import models
 from controllers import user_controller, internal_controller, auth_controller
 from authorization import validate_jwt
-from database import engine
-from utils.utils import get_db
+from database import async_engine, open_influx_pool, close_influx_pool, AsyncSessionLocal
+from utils.montecarlo import start_executor, shutdown_executor
+from utils.directory import refresh_directory, watch_directory
+from utils.reset_codes import sweep_reset_codes
+from utils.schema import upgrade_schema
+from utils.holdings import backfill_holdings
+from utils.outbox import email_worker
+from utils.telemetry import MetricsMiddleware, instrument_engine
+from utils.profiler import ProfilerMiddleware
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with async_engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.create_all, checkfirst=True)
+        await conn.run_sync(upgrade_schema)
+    async with AsyncSessionLocal() as db:
+        await backfill_holdings(db)
+        await refresh_directory(db)
+    directory_watcher = asyncio.create_task(watch_directory())
+    reset_code_sweeper = asyncio.create_task(sweep_reset_codes())
+    email_sender = asyncio.create_task(email_worker())
+    await open_influx_pool()
+    start_executor()
+    yield
+    directory_watcher.cancel()
+    reset_code_sweeper.cancel()
+    email_sender.cancel()
+    shutdown_executor()
+    await close_influx_pool()
+    await async_engine.dispose()
+
+
+instrument_engine(async_engine.sync_engine)
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(auth_controller.router)
 app.include_router(user_controller.router)
 app.include_router(internal_controller.router)
@@ -27,15 +60,15 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
     expose_headers=["*"])
+app.add_middleware(ProfilerMiddleware)
+# outermost, so the latency covers CORS handling and error responses as well
+app.add_middleware(MetricsMiddleware)
 
-models.Base.metadata.create_all(bind=engine, checkfirst=True)
-
-db_dependency = Annotated[Session, Depends(get_db)]
 user_dependency = Annotated[dict, Depends(validate_jwt)]
 
 
 @app.get("/me", status_code=status.HTTP_200_OK)
-async def user(user: user_dependency, db: db_dependency):
+async def user(user: user_dependency):
     if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Authentication required")
     return {"User": user}
@@ -1,4 +1,4 @@
-from sqlalchemy import Table, Column, Integer, String, DateTime, ForeignKey, DECIMAL, Date
+from sqlalchemy import Table, Column, Integer, String, DateTime, ForeignKey, DECIMAL, Date, Index, Text
 from sqlalchemy import Enum
 from sqlalchemy.orm import relationship
 import enum
@@ -9,10 +9,17 @@ class UserTransaction(Base):
     __tablename__ = 'user_transaction'
     user_id = Column(Integer, ForeignKey('user.id'), primary_key=True)
     transaction_id = Column(Integer, ForeignKey('transaction.id', ondelete='CASCADE'), primary_key=True)
+    # copy of transaction.transaction_date so a user's history can be walked from one index
+    transaction_date = Column(Date, nullable=False)
     
     transaction = relationship("Transaction", back_populates="users")
     user = relationship("User", back_populates="transactions")
 
+    # keyset pagination of /user/transactions and the export walk (user_id, transaction_date, transaction_id)
+    __table_args__ = (
+        Index('ix_user_transaction_user_date', 'user_id', 'transaction_date', 'transaction_id'),
+    )
+
 
 
 class User(Base):
@@ -42,6 +49,16 @@ class TransactionType(enum.Enum):
     BUY = 'buy'
     SELL = 'sell'
 
+    @classmethod
+    def parse(cls, value) -> 'TransactionType':
+        # accepts the enum itself, its name ('BUY') or its value ('buy')
+        if isinstance(value, cls):
+            return value
+        try:
+            return cls[str(value).upper()]
+        except KeyError:
+            raise ValueError(f"Invalid transaction type: {value}")
+
 
 class Transaction(Base):
     __tablename__ = 'transaction'
@@ -51,6 +68,52 @@ class Transaction(Base):
     transaction_date = Column(Date, nullable=False)
     transaction_type = Column(Enum(TransactionType))
     company_id = Column(Integer, ForeignKey('company.id'))
+    # set while a csv import chunk links its rows to the user, NULL otherwise
+    import_token = Column(String(32), nullable=True, index=True)
     
     users = relationship("UserTransaction", back_populates="transaction")
     company = relationship("Company", back_populates="transactions")
+
+
+class Holding(Base):
+    __tablename__ = 'holding'
+    user_id = Column(Integer, ForeignKey('user.id'), primary_key=True)
+    company_id = Column(Integer, ForeignKey('company.id'), primary_key=True)
+    amount = Column(Integer, nullable=False, default=0)  # bought - sold
+    buy_amount = Column(Integer, nullable=False, default=0)
+    buy_cost = Column(DECIMAL(20, 2), nullable=False, default=0)
+    sell_amount = Column(Integer, nullable=False, default=0)
+    sell_cost = Column(DECIMAL(20, 2), nullable=False, default=0)
+
+
+class CacheVersion(Base):
+    # bumped whenever a table cached in-process changes so other workers can reload it
+    __tablename__ = 'cache_version'
+    name = Column(String(50), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class PasswordResetCode(Base):
+    __tablename__ = 'password_reset_code'
+    code = Column(String(64), primary_key=True)
+    email = Column(String(255), nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class EmailOutbox(Base):
+    __tablename__ = 'email_outbox'
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    to_email = Column(String(255), nullable=False)
+    subject = Column(String(255), nullable=False)
+    html_content = Column(Text, nullable=False)
+    status = Column(String(20), nullable=False, default='pending')
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False)
+    last_error = Column(String(500))
+    created_at = Column(DateTime, nullable=False)
+    sent_at = Column(DateTime)
+
+    __table_args__ = (
+        # the worker only ever scans pending rows in due order
+        Index('ix_email_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
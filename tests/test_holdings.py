@@ -0,0 +1,56 @@
+import asyncio
+import json
+import tempfile
+from pathlib import Path
+
+from benchmarks.harness import configure_environment, install_fake_influx, AsgiClient, seed
+
+configure_environment(Path(tempfile.mkdtemp(prefix="holdings-test-")))
+
+import main  # noqa: E402  reads its settings on import
+
+
+async def _wallet(session) -> list[dict]:
+    code, body = await session.client.request("GET", "/user/wallet", session.user_headers)
+    assert code == 200, body
+    return json.loads(body)
+
+
+async def _buy(session, company_id: int, amount: int):
+    code, body = await session.client.request("PUT", "/user/transaction", session.user_headers, json_body={
+        "amount": amount,
+        "price_per_unit": 10,
+        "transaction_date": "2024-01-01",
+        "transaction_type": "BUY",
+        "company_id": company_id,
+    })
+    assert code == 200, body
+
+
+async def _concurrent_delete() -> tuple[list[int], list[dict]]:
+    install_fake_influx(main.app)
+    async with main.lifespan(main.app):
+        session = await seed(AsgiClient(main.app), transactions=0)
+        company_id = session.company_ids[0]
+        await _buy(session, company_id, 10)
+        await _buy(session, company_id, 3)
+
+        code, body = await session.client.request("GET", f"/user/transactions?company_id={company_id}",
+                                                  session.user_headers)
+        assert code == 200, body
+        transaction_id = next(t["id"] for t in json.loads(body)["transactions"] if t["amount"] == 3)
+
+        # a double-clicked delete, both requests read the row before either commits
+        responses = await asyncio.gather(*(
+            session.client.request("DELETE", "/user/transaction", session.user_headers,
+                                   json_body={"id": transaction_id})
+            for _ in range(2)
+        ))
+        return sorted(code for code, _ in responses), await _wallet(session)
+
+
+def test_concurrent_delete_takes_the_transaction_off_the_holding_once():
+    codes, wallet = asyncio.run(_concurrent_delete())
+
+    assert codes == [200, 404]
+    assert [holding["amount"] for holding in wallet] == [10]
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Hashable, Optional
+
+import pandas as pd
+from pandas import DataFrame
+
+logger = logging.getLogger(__name__)
+
+Fetch = Callable[[datetime, datetime], Awaitable[Optional[DataFrame]]]
+
+
+@dataclass
+class _Entry:
+    frame: DataFrame
+    window: timedelta  # longest history any caller asked for
+    fetched_at: float
+    size: int
+
+
+def _utc(value: datetime) -> pd.Timestamp:
+    return pd.Timestamp(value, tz="UTC")
+
+
+# One lock per key, dropped as soon as nobody holds or waits for it so keys taken from
+# request input (unknown symbols, failed fetches) do not pile up.
+class KeyedLocks:
+
+    def __init__(self):
+        self._locks: dict[Hashable, list] = {}  # key -> [lock, holders and waiters]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def __call__(self, key: Hashable):
+        slot = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                yield
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0:
+                del self._locks[key]
+
+
+# Candle frames keyed by symbol. Frames carry a tz-aware `_time` column, a stale entry only
+# fetches the rows from its last cached timestamp onwards and appends them, so history is
+# read from Influx once per window instead of once per request.
+class TimeSeriesCache:
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, _Entry] = OrderedDict()
+        self._locks = KeyedLocks()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.evictions = 0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._size,
+        }
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+    async def get(self, key: Hashable, start: datetime, stop: datetime, fetch: Fetch) -> Optional[DataFrame]:
+        if self.max_bytes <= 0:
+            return await fetch(start, stop)
+
+        async with self._locks(key):
+            entry = self._entries.get(key)
+            if entry is None or _utc(stop) - entry.window > _utc(start):
+                self.misses += 1
+                frame = await fetch(start, stop)
+                if not self._cacheable(frame):
+                    return frame
+                entry = self._store(key, frame, stop - start)
+            elif time.monotonic() - entry.fetched_at > self.ttl:
+                self.refreshes += 1
+                entry = await self._refresh(key, entry, stop, fetch)
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+
+        frame = entry.frame
+        return frame[frame["_time"] >= _utc(start)].reset_index(drop=True)
+
+    async def _refresh(self, key: Hashable, entry: _Entry, stop: datetime, fetch: Fetch) -> _Entry:
+        last = entry.frame["_time"].iloc[-1]
+        tail = await fetch(last.tz_convert(None).to_pydatetime(), stop)
+        if not isinstance(tail, DataFrame):
+            logger.warning(f"Failed to refresh cached candles for {key}, serving stale data")
+            return entry
+
+        frame = entry.frame
+        if self._cacheable(tail):
+            # the newest cached candle may still have been open, the tail replaces it
+            frame = pd.concat([frame[frame["_time"] < last], tail], ignore_index=True)
+        frame = frame[frame["_time"] >= _utc(stop) - entry.window]
+        return self._store(key, frame, entry.window)
+
+    def _cacheable(self, frame) -> bool:
+        return isinstance(frame, DataFrame) and not frame.empty and "_time" in frame.columns
+
+    def _store(self, key: Hashable, frame: DataFrame, window: timedelta) -> _Entry:
+        frame = frame.sort_values("_time", kind="stable", ignore_index=True)
+        entry = _Entry(frame=frame, window=window, fetched_at=time.monotonic(),
+                       size=int(frame.memory_usage(deep=True).sum()))
+        self._discard(key)
+        if entry.size > self.max_bytes:
+            return entry
+
+        self._entries[key] = entry
+        self._size += entry.size
+        while self._size > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._discard(oldest)
+            self.evictions += 1
+        return entry
+
+    def _discard(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry.size
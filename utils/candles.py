@@ -0,0 +1,118 @@
+import io
+import json
+from typing import Optional
+
+import numpy as np
+from pandas import DataFrame
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+# response column -> pivoted Influx field
+CANDLE_COLUMNS = {
+    "open": "OpenPrice",
+    "high": "HighPrice",
+    "low": "LowPrice",
+    "close": "ClosePrice",
+    "volume": "Volume",
+}
+
+
+def available_media_types() -> list[str]:
+    media_types = [JSON_MEDIA_TYPE]
+    if msgpack is not None:
+        media_types.append(MSGPACK_MEDIA_TYPE)
+    if pa is not None:
+        media_types.append(ARROW_MEDIA_TYPE)
+    return media_types
+
+
+def _accept_q(params: list[str]) -> float:
+    for param in params:
+        name, _, value = param.partition("=")
+        if name.strip().lower() == "q":
+            try:
+                return min(max(float(value), 0.0), 1.0)
+            except ValueError:
+                return 0.0
+    return 1.0
+
+
+def negotiate_media_type(accept: Optional[str]) -> Optional[str]:
+    if not accept:
+        return JSON_MEDIA_TYPE
+    available = available_media_types()
+    ranges = []
+    refused = set()
+    for part in accept.split(","):
+        media_type, *params = part.split(";")
+        media_type = media_type.strip().lower()
+        q = _accept_q(params)
+        if q > 0:
+            ranges.append((q, media_type))
+        else:
+            refused.add(media_type)
+    # highest q first, ties keep the client's order
+    for _, media_type in sorted(ranges, key=lambda item: -item[0]):
+        if media_type in ("*/*", "application/*"):
+            allowed = [candidate for candidate in available if candidate not in refused]
+            return allowed[0] if allowed else None
+        if media_type in available:
+            return media_type
+    return None
+
+
+def _times(data: DataFrame) -> np.ndarray:
+    # naive datetime64 in UTC, influx always returns tz-aware _time
+    return data["_time"].dt.tz_convert(None).to_numpy(dtype="datetime64[ms]")
+
+
+def _values(column: np.ndarray) -> list:
+    values = column.tolist()
+    if column.dtype.kind == "f" and np.isnan(column).any():
+        values = [None if value != value else value for value in values]
+    return values
+
+
+def encode_json(data: DataFrame) -> bytes:
+    columns = {"time": np.datetime_as_string(_times(data), unit="s", timezone="UTC").tolist()}
+    for name, field in CANDLE_COLUMNS.items():
+        columns[name] = _values(data[field].to_numpy())
+    return json.dumps(columns, separators=(",", ":")).encode()
+
+
+def encode_msgpack(data: DataFrame) -> bytes:
+    # epoch milliseconds, binary clients should not have to parse ISO strings
+    columns = {"time": _times(data).astype(np.int64).tolist()}
+    for name, field in CANDLE_COLUMNS.items():
+        columns[name] = _values(data[field].to_numpy())
+    return msgpack.packb(columns)
+
+
+def encode_arrow(data: DataFrame) -> bytes:
+    arrays = [pa.array(_times(data), type=pa.timestamp("ms", tz="UTC"))]
+    arrays.extend(pa.array(data[field].to_numpy()) for field in CANDLE_COLUMNS.values())
+    table = pa.Table.from_arrays(arrays, names=["time", *CANDLE_COLUMNS])
+
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+ENCODERS = {
+    JSON_MEDIA_TYPE: encode_json,
+    MSGPACK_MEDIA_TYPE: encode_msgpack,
+    ARROW_MEDIA_TYPE: encode_arrow,
+}
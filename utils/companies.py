@@ -0,0 +1,58 @@
+from sqlalchemy import select
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Company
+
+UPSERT_CHUNK_SIZE = 1000
+
+
+def _upsert_statement(dialect_name: str, rows: list[dict]):
+    if dialect_name == 'sqlite':
+        statement = sqlite.insert(Company).values(rows)
+        return statement.on_conflict_do_update(index_elements=['company_symbol'],
+                                               set_={'company_name': statement.excluded.company_name})
+    statement = mysql.insert(Company).values(rows)
+    return statement.on_duplicate_key_update(company_name=statement.inserted.company_name)
+
+
+async def _upsert_chunk(db: AsyncSession, chunk: dict[str, str], counts: dict):
+    names_by_symbol = dict((await db.execute(
+        select(Company.company_symbol, Company.company_name).where(Company.company_symbol.in_(chunk))
+    )).all())
+    symbols_by_name = dict((await db.execute(
+        select(Company.company_name, Company.company_symbol).where(Company.company_name.in_(chunk.values()))
+    )).all())
+
+    rows = []
+    for symbol, name in chunk.items():
+        owner = symbols_by_name.get(name)
+        if owner is not None and owner != symbol:
+            # the name belongs to another listing, overwriting it would break the unique name
+            counts['conflicts'] += 1
+        elif symbol not in names_by_symbol:
+            counts['inserted'] += 1
+            rows.append({'company_symbol': symbol, 'company_name': name})
+        elif names_by_symbol[symbol] != name:
+            counts['updated'] += 1
+            rows.append({'company_symbol': symbol, 'company_name': name})
+        else:
+            counts['unchanged'] += 1
+        symbols_by_name.setdefault(name, symbol)
+
+    if rows:
+        dialect_name = (await db.connection()).dialect.name
+        await db.execute(_upsert_statement(dialect_name, rows))
+    await db.commit()
+
+
+async def upsert_companies(db: AsyncSession, companies: list[tuple[str, str]]) -> dict:
+    # keyed by symbol, the last entry for a symbol wins
+    listings = {symbol: name for name, symbol in companies}
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'conflicts': 0}
+
+    symbols = list(listings)
+    for start in range(0, len(symbols), UPSERT_CHUNK_SIZE):
+        chunk = {symbol: listings[symbol] for symbol in symbols[start:start + UPSERT_CHUNK_SIZE]}
+        await _upsert_chunk(db, chunk, counts)
+    return counts
@@ -0,0 +1,164 @@
+import codecs
+import uuid
+from collections import defaultdict
+from datetime import date
+
+from aiocsv import AsyncDictReader
+from fastapi import UploadFile
+from pydantic import BaseModel, Field, ValidationError, field_validator
+from sqlalchemy import select, insert, update, literal
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Company, Transaction, TransactionType, UserTransaction
+from utils.directory import get_directory
+from utils.holdings import holding_delta, apply_holding_delta
+
+IMPORT_CHUNK_SIZE = 1000  # rows validated, inserted and committed together
+MAX_REPORTED_ERRORS = 1000
+REQUIRED_COLUMNS = {'company_symbol', 'amount', 'price_per_unit', 'transaction_date', 'transaction_type'}
+# ranges of transaction.amount (INT) and transaction.price_per_unit (DECIMAL(10, 2))
+MAX_AMOUNT = 2 ** 31 - 1
+MAX_PRICE = 99_999_999.99
+
+
+class ImportRow(BaseModel):
+    company_symbol: str
+    amount: int = Field(gt=0, le=MAX_AMOUNT)
+    price_per_unit: float = Field(gt=0, le=MAX_PRICE)
+    transaction_date: date
+    transaction_type: TransactionType
+
+    @field_validator('transaction_type', mode='before')
+    @classmethod
+    def parse_type(cls, value):
+        return TransactionType.parse(value)
+
+
+class ImportReport:
+
+    def __init__(self):
+        self.imported = 0
+        self.failed = 0
+        self.errors: list[dict] = []
+
+    def error(self, row_number: int, message: str):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row_number, 'error': message})
+
+    def as_dict(self) -> dict:
+        return {
+            'imported': self.imported,
+            'failed': self.failed,
+            'errors': self.errors,
+            'errors_truncated': self.failed > len(self.errors)
+        }
+
+
+class _TextStream:
+    # aiocsv reads str, UploadFile hands out bytes from its spooled file a chunk at a time
+
+    def __init__(self, upload: UploadFile, encoding: str = 'utf-8-sig'):
+        self._upload = upload
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+
+    async def read(self, size: int) -> str:
+        while True:
+            chunk = await self._upload.read(size)
+            text = self._decoder.decode(chunk, final=not chunk)
+            if text or not chunk:
+                return text
+
+
+def _validation_message(error: ValidationError) -> str:
+    details = error.errors()[0]
+    field = '.'.join(str(part) for part in details['loc'])
+    return f"{field}: {details['msg']}" if field else details['msg']
+
+
+async def _insert_transactions(db: AsyncSession, user_id: int, values: list[dict]):
+    # MySQL has no RETURNING and the ids of a multi-row insert are not guaranteed to be consecutive,
+    # the chunk is tagged with a token instead and linked to the user by selecting it back
+    token = uuid.uuid4().hex
+    await db.execute(insert(Transaction), [{**row, 'import_token': token} for row in values])
+    await db.execute(insert(UserTransaction).from_select(
+        ['user_id', 'transaction_id', 'transaction_date'],
+        select(literal(user_id), Transaction.id, Transaction.transaction_date)
+        .where(Transaction.import_token == token)
+    ))
+    await db.execute(update(Transaction).where(Transaction.import_token == token).values(import_token=None))
+
+
+async def _import_chunk(db: AsyncSession, user_id: int, chunk: list[tuple[int, dict]], report: ImportReport):
+    rows: list[tuple[int, ImportRow]] = []
+    for row_number, raw in chunk:
+        try:
+            rows.append((row_number, ImportRow.model_validate(raw)))
+        except ValidationError as e:
+            report.error(row_number, _validation_message(e))
+
+    directory = get_directory()
+    symbols = {row.company_symbol for _, row in rows}
+    companies = {symbol: directory.by_symbol[symbol].id for symbol in symbols if symbol in directory.by_symbol}
+    missing = symbols - companies.keys()
+    if missing:
+        # not in this worker's directory yet, or really unknown
+        companies.update((await db.execute(
+            select(Company.company_symbol, Company.id).where(Company.company_symbol.in_(missing))
+        )).all())
+
+    values = []
+    row_numbers = []
+    deltas = defaultdict(lambda: defaultdict(int))
+    for row_number, row in rows:
+        company_id = companies.get(row.company_symbol)
+        if company_id is None:
+            report.error(row_number, f"Unknown company symbol: {row.company_symbol}")
+            continue
+        values.append({
+            'amount': row.amount,
+            'price_per_unit': row.price_per_unit,
+            'transaction_date': row.transaction_date,
+            'transaction_type': row.transaction_type,
+            'company_id': company_id
+        })
+        row_numbers.append(row_number)
+        for column, value in holding_delta(row.transaction_type, row.amount, row.price_per_unit).items():
+            deltas[company_id][column] += value
+
+    if not values:
+        return
+
+    try:
+        await _insert_transactions(db, user_id, values)
+        for company_id, delta in deltas.items():
+            await apply_holding_delta(db, [user_id], company_id, delta)
+        await db.commit()
+    except DBAPIError as e:
+        # the chunk is written as a whole, earlier chunks stay imported and the rest still runs
+        await db.rollback()
+        for row_number in row_numbers:
+            report.error(row_number, f"Rejected by the database: {e.orig}")
+        return
+    report.imported += len(values)
+
+
+async def import_transactions(db: AsyncSession, user_id: int, upload: UploadFile) -> dict:
+    reader = AsyncDictReader(_TextStream(upload))
+    report = ImportReport()
+    chunk = []
+    row_number = 0
+    async for raw in reader:
+        if row_number == 0:
+            missing = REQUIRED_COLUMNS - set(reader.fieldnames or [])
+            if missing:
+                raise ValueError(f"Missing columns: {', '.join(sorted(missing))}")
+        row_number += 1
+        chunk.append((row_number, raw))
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            await _import_chunk(db, user_id, chunk, report)
+            chunk = []
+    if chunk:
+        await _import_chunk(db, user_id, chunk, report)
+    return report.as_dict()
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import os
+from dataclasses import dataclass, field
+
+import pandas as pd
+from sqlalchemy import select, update, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import AsyncSessionLocal
+from models import Company, CacheVersion
+
+logger = logging.getLogger(__name__)
+
+DIRECTORY_POLL_SECONDS = float(os.getenv('DIRECTORY_POLL_SECONDS', '5'))
+DIRECTORY_CACHE_NAME = 'company'
+
+
+@dataclass(frozen=True)
+class CompanyEntry:
+    id: int
+    name: str
+    symbol: str
+
+
+@dataclass(frozen=True)
+class CompanyDirectory:
+    version: int = -1
+    companies: tuple[CompanyEntry, ...] = ()  # ordered by id
+    by_id: dict[int, CompanyEntry] = field(default_factory=dict)
+    by_symbol: dict[str, CompanyEntry] = field(default_factory=dict)
+    by_name: dict[str, CompanyEntry] = field(default_factory=dict)
+    frame: pd.DataFrame = field(default_factory=lambda: pd.DataFrame(columns=['id', 'name', 'symbol']))
+
+    @classmethod
+    def build(cls, version: int, companies: list[CompanyEntry]) -> 'CompanyDirectory':
+        return cls(
+            version=version,
+            companies=tuple(companies),
+            by_id={company.id: company for company in companies},
+            by_symbol={company.symbol: company for company in companies},
+            by_name={company.name: company for company in companies},
+            frame=pd.DataFrame([(company.id, company.name, company.symbol) for company in companies],
+                               columns=['id', 'name', 'symbol']),
+        )
+
+
+# replaced as a whole, readers take one reference per request and never see a half-built directory
+_directory = CompanyDirectory()
+
+
+def get_directory() -> CompanyDirectory:
+    return _directory
+
+
+async def current_version(db: AsyncSession) -> int:
+    version = await db.scalar(select(CacheVersion.version).where(CacheVersion.name == DIRECTORY_CACHE_NAME))
+    return version or 0
+
+
+async def bump_version(db: AsyncSession):
+    result = await db.execute(
+        update(CacheVersion)
+        .where(CacheVersion.name == DIRECTORY_CACHE_NAME)
+        .values(version=CacheVersion.version + 1)
+    )
+    if result.rowcount == 0:
+        await db.execute(insert(CacheVersion).values(name=DIRECTORY_CACHE_NAME, version=1))
+    await db.commit()
+
+
+async def refresh_directory(db: AsyncSession) -> CompanyDirectory:
+    global _directory
+    version = await current_version(db)
+    rows = (await db.execute(
+        select(Company.id, Company.company_name, Company.company_symbol).order_by(Company.id)
+    )).all()
+    _directory = CompanyDirectory.build(version, [CompanyEntry(*row) for row in rows])
+    return _directory
+
+
+async def watch_directory():
+    # polls the version row so writes made through another worker show up within one interval
+    while True:
+        await asyncio.sleep(DIRECTORY_POLL_SECONDS)
+        try:
+            async with AsyncSessionLocal() as db:
+                if await current_version(db) != _directory.version:
+                    await refresh_directory(db)
+        except Exception as e:
+            logger.warning(f"Failed to refresh company directory. Reason: {e}")
@@ -0,0 +1,124 @@
+import argparse
+import asyncio
+from decimal import Decimal
+from typing import Optional, Iterable
+
+from sqlalchemy import select, insert, delete, func, case
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Holding, Transaction, TransactionType, UserTransaction
+
+HOLDING_COLUMNS = ('amount', 'buy_amount', 'buy_cost', 'sell_amount', 'sell_cost')
+
+
+def holding_delta(transaction_type, amount: int, price_per_unit, sign: int = 1) -> dict:
+    # price is rounded the way the DECIMAL(10, 2) column stores it so rebuilds give the same totals
+    cost = Decimal(str(price_per_unit)).quantize(Decimal('0.01')) * amount * sign
+    amount = amount * sign
+    delta = dict.fromkeys(HOLDING_COLUMNS, 0)
+    if transaction_type is None:
+        return delta
+    if TransactionType.parse(transaction_type) == TransactionType.BUY:
+        delta.update(amount=amount, buy_amount=amount, buy_cost=cost)
+    else:
+        delta.update(amount=-amount, sell_amount=amount, sell_cost=cost)
+    return delta
+
+
+def _upsert_statement(dialect_name: str, rows: list[dict]):
+    # concurrent first writes for the same (user, company) both insert, the conflict adds instead
+    if dialect_name == 'sqlite':
+        statement = sqlite.insert(Holding).values(rows)
+        return statement.on_conflict_do_update(
+            index_elements=['user_id', 'company_id'],
+            set_={column: getattr(Holding, column) + getattr(statement.excluded, column) for column in HOLDING_COLUMNS}
+        )
+    statement = mysql.insert(Holding).values(rows)
+    return statement.on_duplicate_key_update(
+        {column: getattr(Holding, column) + getattr(statement.inserted, column) for column in HOLDING_COLUMNS}
+    )
+
+
+async def apply_holding_delta(db: AsyncSession, user_ids: Iterable[int], company_id: int, delta: dict):
+    rows = [{'user_id': user_id, 'company_id': company_id, **delta} for user_id in user_ids]
+    if not rows or not any(delta.values()):
+        return
+    dialect_name = (await db.connection()).dialect.name
+    await db.execute(_upsert_statement(dialect_name, rows))
+
+
+def holdings_select():
+    is_buy = Transaction.transaction_type == TransactionType.BUY
+    is_sell = Transaction.transaction_type == TransactionType.SELL
+    cost = Transaction.amount * Transaction.price_per_unit
+    buy_amount = func.coalesce(func.sum(case((is_buy, Transaction.amount), else_=0)), 0)
+    sell_amount = func.coalesce(func.sum(case((is_sell, Transaction.amount), else_=0)), 0)
+
+    return (
+        select(
+            UserTransaction.user_id,
+            Transaction.company_id,
+            buy_amount - sell_amount,
+            buy_amount,
+            func.coalesce(func.sum(case((is_buy, cost), else_=0)), 0),
+            sell_amount,
+            func.coalesce(func.sum(case((is_sell, cost), else_=0)), 0),
+        )
+        .join(UserTransaction, UserTransaction.transaction_id == Transaction.id)
+        .where(Transaction.company_id.is_not(None))
+        .group_by(UserTransaction.user_id, Transaction.company_id)
+    )
+
+
+async def rebuild_holdings(db: AsyncSession, user_id: Optional[int] = None) -> int:
+    # recomputes holdings from the transaction history in two statements, the caller commits
+    clear = delete(Holding)
+    source = holdings_select()
+    if user_id is not None:
+        clear = clear.where(Holding.user_id == user_id)
+        source = source.where(UserTransaction.user_id == user_id)
+
+    await db.execute(clear)
+    result = await db.execute(
+        insert(Holding).from_select(['user_id', 'company_id', *HOLDING_COLUMNS], source)
+    )
+    return result.rowcount
+
+
+async def backfill_holdings(db: AsyncSession) -> int:
+    # the holding table starts empty on databases that already have transactions,
+    # fill it once at startup so wallets are not served from an empty table
+    if await db.scalar(select(Holding.user_id).limit(1)) is not None:
+        return 0
+    if await db.scalar(select(UserTransaction.user_id).limit(1)) is None:
+        return 0
+    try:
+        rows = await rebuild_holdings(db)
+        await db.commit()
+    except IntegrityError:
+        # another worker started at the same time and filled it first
+        await db.rollback()
+        return 0
+    return rows
+
+
+async def _main():
+    from database import AsyncSessionLocal, async_engine, Base
+
+    parser = argparse.ArgumentParser(description='Rebuild the holding table from transactions')
+    parser.add_argument('--user-id', type=int, default=None)
+    args = parser.parse_args()
+
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, checkfirst=True)
+    async with AsyncSessionLocal() as db:
+        rows = await rebuild_holdings(db, args.user_id)
+        await db.commit()
+    await async_engine.dispose()
+    print(f'Rebuilt {rows} holdings')
+
+
+if __name__ == '__main__':
+    asyncio.run(_main())
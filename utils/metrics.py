@@ -1,11 +1,16 @@
 import math
+from typing import Optional
+
 import numpy as np
 import pandas as pd
 
-from database import get_influx_client
+from database import InfluxClient
+from utils.montecarlo import run_simulation
+from utils.returns import daily_returns, SymbolReturns
+from utils.telemetry import compute_seconds, timed
 
 
-async def get_metric(companies_values: dict[str, float]) -> dict:
+async def get_metric(companies_values: dict[str, float], client: Optional[InfluxClient] = None) -> dict:
     result = {
         "ROI": None,
         "STDDEV": None,
@@ -13,19 +18,10 @@ async def get_metric(companies_values: dict[str, float]) -> dict:
         "SHARPE": None,
         "RECOMMENDATION": None,
     }
-    companies = list(companies_values.keys())
-    roi, company_df = await calculate_rois(companies)
-    covariances = {(a, b): calculate_covariance(a, b, company_df) for idx_a, a in enumerate(companies) for b in
-                   companies[idx_a + 1:]}
+    weights, mean, covariance = await portfolio_inputs(companies_values, client)
 
-    investment_sum = sum([value for _, value in companies_values.items()])
-    weights = {company: value / investment_sum for company, value in companies_values.items()}
-
-    rois_small = [roi[symbol] * weights[symbol] for symbol in companies]
-    result["ROI"] = sum(rois_small)
-    stddev_base = [weights[a] ** 2 * company_df[a]['StdDev'].min() ** 2 for a in companies]
-    stddev_base.extend([weights[a] * weights[b] * covariances[a, b] * 2 for a, b in covariances])
-    result["STDDEV"] = math.sqrt(sum(stddev_base))
+    result["ROI"] = float(weights @ mean)
+    result["STDDEV"] = math.sqrt(weights @ covariance @ weights)
     stddev = result["STDDEV"]
     roi = result["ROI"]
     result["INTERVAL"] = (roi - stddev, roi + stddev)
@@ -43,27 +39,37 @@ async def get_metric(companies_values: dict[str, float]) -> dict:
     return result
 
 
-def calculate_covariance(company_a: str, company_b: str, company_df) -> float:
-    if company_df[company_a].empty or company_df[company_b].empty:
-        return
-    a_df = company_df[company_a].dropna(how="any")
-    b_df = company_df[company_b].dropna(how="any")
-    return np.cov(a_df["DailyReturns"], b_df["DailyReturns"])[0][1]
+async def get_scenarios(companies_values: dict[str, float], paths: int, horizon: int,
+                        client: Optional[InfluxClient] = None) -> dict:
+    weights, mean, covariance = await portfolio_inputs(companies_values, client)
+    return await run_simulation(mean, covariance, weights, paths, horizon)
+
+
+async def portfolio_inputs(companies_values: dict[str, float],
+                           client: Optional[InfluxClient] = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    companies = list(companies_values.keys())
+    returns = await daily_returns.get(companies, client)
+    missing = [symbol for symbol in companies if symbol not in returns]
+    if missing:
+        raise LookupError(f"No data found for {', '.join(missing)}")
+
+    with timed(compute_seconds, step='portfolio_inputs'):
+        investment = np.array([companies_values[symbol] for symbol in companies], dtype=float)
+        weights = investment / investment.sum()
+        mean = np.array([returns[symbol].mean for symbol in companies], dtype=float)
+        matrix = daily_returns_matrix(companies, returns)
+        if len(matrix) < 2:
+            # np.cov of fewer than two days is NaN and every metric built on it with it
+            raise LookupError(f"Not enough overlapping history for {', '.join(companies)}")
+        covariance = covariance_matrix(matrix)
+    return weights, mean, covariance
+
 
+def daily_returns_matrix(companies: list[str], returns: dict[str, SymbolReturns]) -> pd.DataFrame:
+    # one column per symbol, only the days every symbol traded on so covariances compare the same dates
+    matrix = pd.concat({symbol: returns[symbol].returns for symbol in companies}, axis=1)
+    return matrix.dropna(how="any")
 
-async def calculate_rois(companies: list[str]) -> tuple[dict, dict]:
-    roi = {symbol: 0 for symbol in companies}
-    company_df = {}
-    for symbol in companies:
-        client = await get_influx_client()
-        df = await client.query_data("3m", symbol)
 
-        # df = query_data(symbol,
-        #                 "-3mo")  # tutaj query do influxa musicie przerobić pod swój kod, powinien wracać dataframe z danymi pojedynczej firmy
-        df = pd.DataFrame(df.groupby([df._time.dt.year, df._time.dt.month, df._time.dt.day])["ClosePrice"].mean())
-        df["PreviousCloseMean"] = df.shift(1)
-        df["DailyReturns"] = ((df["ClosePrice"] - df["PreviousCloseMean"]) / df["PreviousCloseMean"]) * 100
-        df["StdDev"] = df["DailyReturns"].std()
-        roi[symbol] = df["DailyReturns"].mean()
-        company_df[symbol] = df
-    return roi, company_df
+def covariance_matrix(returns: pd.DataFrame) -> np.ndarray:
+    return np.atleast_2d(np.cov(returns.to_numpy(), rowvar=False))
@@ -0,0 +1,87 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Optional
+
+import numpy as np
+
+MONTE_CARLO_WORKERS = int(os.getenv('MONTE_CARLO_WORKERS', str(os.cpu_count() or 1)))
+MONTE_CARLO_CPU_BUDGET = float(os.getenv('MONTE_CARLO_CPU_BUDGET', '2'))  # CPU seconds per request
+MONTE_CARLO_TIMEOUT = float(os.getenv('MONTE_CARLO_TIMEOUT', '30'))  # seconds including time queued
+MONTE_CARLO_MAX_PATHS = int(os.getenv('MONTE_CARLO_MAX_PATHS', '100000'))
+
+# random draws generated per batch, bounds worker memory at roughly 8 bytes * this
+BATCH_ELEMENTS = 2_000_000
+PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def start_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # the app already runs threads (bcrypt pool, to_thread, aiohttp) when the pool starts,
+        # forking would copy their held locks into the workers, forkserver starts them clean
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        _executor = ProcessPoolExecutor(max_workers=MONTE_CARLO_WORKERS,
+                                        mp_context=multiprocessing.get_context(start_method))
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _factor(covariance: np.ndarray) -> np.ndarray:
+    # covariance estimated from overlapping histories can be singular, eigh tolerates that
+    values, vectors = np.linalg.eigh(covariance)
+    return vectors * np.sqrt(np.clip(values, 0, None))
+
+
+def simulate_portfolio(mean: np.ndarray, covariance: np.ndarray, weights: np.ndarray, paths: int, horizon: int,
+                       cpu_budget: float = MONTE_CARLO_CPU_BUDGET, seed: Optional[int] = None) -> dict:
+    started = time.process_time()
+    rng = np.random.default_rng(seed)
+    factor = _factor(np.atleast_2d(covariance))
+    symbols = len(weights)
+    batch = max(1, BATCH_ELEMENTS // (horizon * symbols))
+
+    # buy and hold: every position compounds its own daily returns (percent) over the horizon
+    outcomes = np.empty(paths)
+    done = 0
+    while done < paths:
+        size = min(batch, paths - done)
+        shocks = rng.standard_normal((size, horizon, symbols)) @ factor.T
+        growth = np.prod(1 + (mean + shocks) / 100, axis=1)
+        outcomes[done:done + size] = (growth @ weights - 1) * 100
+        done += size
+        if time.process_time() - started > cpu_budget:
+            break
+    outcomes = outcomes[:done]
+
+    percentiles = np.percentile(outcomes, PERCENTILES)
+    var_95, var_99 = -percentiles[PERCENTILES.index(5)], -percentiles[PERCENTILES.index(1)]
+    return {
+        "paths": done,
+        "truncated": done < paths,
+        "cpu_seconds": time.process_time() - started,
+        "expected_return": float(outcomes.mean()),
+        "percentiles": {f"p{p}": float(value) for p, value in zip(PERCENTILES, percentiles)},
+        "var_95": float(var_95),
+        "cvar_95": float(-outcomes[outcomes <= -var_95].mean()),
+        "var_99": float(var_99),
+        "cvar_99": float(-outcomes[outcomes <= -var_99].mean()),
+    }
+
+
+async def run_simulation(mean: np.ndarray, covariance: np.ndarray, weights: np.ndarray, paths: int,
+                         horizon: int) -> dict:
+    loop = asyncio.get_running_loop()
+    task = partial(simulate_portfolio, mean, covariance, weights, paths, horizon, MONTE_CARLO_CPU_BUDGET)
+    return await asyncio.wait_for(loop.run_in_executor(start_executor(), task), timeout=MONTE_CARLO_TIMEOUT)
@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import os
+import smtplib
+import uuid
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from pathlib import Path
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import AsyncSessionLocal
+from models import EmailOutbox
+
+logger = logging.getLogger(__name__)
+
+# sendgrid | smtp | file, file writes .eml files to EMAIL_FILE_DIR for local runs and tests
+EMAIL_TRANSPORT = os.getenv('EMAIL_TRANSPORT', 'sendgrid')
+EMAIL_BATCH_SIZE = int(os.getenv('EMAIL_BATCH_SIZE', '20'))
+EMAIL_MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS', '5'))
+EMAIL_RETRY_SECONDS = float(os.getenv('EMAIL_RETRY_SECONDS', '5'))  # doubled after every failed attempt
+EMAIL_POLL_SECONDS = float(os.getenv('EMAIL_POLL_SECONDS', '30'))  # picks up retries and other workers' rows
+EMAIL_CLAIM_SECONDS = float(os.getenv('EMAIL_CLAIM_SECONDS', '300'))  # a claimed row is retried after this
+
+outbox_stats = {
+    "enqueued": 0,
+    "sent": 0,
+    "retried": 0,
+    "failed": 0,
+}
+
+
+class SendGridTransport:
+
+    def __init__(self):
+        from sendgrid import SendGridAPIClient
+        self._client = SendGridAPIClient(os.getenv('SENDGRID_API_KEY'))
+
+    def send(self, to_email: str, subject: str, html_content: str):
+        from sendgrid.helpers.mail import Mail
+        message = Mail(
+            from_email=os.getenv('FROM_EMAIL'),
+            to_emails=to_email,
+            subject=subject,
+            html_content=html_content
+        )
+        response = self._client.send(message)
+        if response.status_code >= 400:
+            raise RuntimeError(f"SendGrid responded with {response.status_code}")
+
+
+class SmtpTransport:
+
+    def __init__(self):
+        self.host = os.getenv('SMTP_HOST', 'localhost')
+        self.port = int(os.getenv('SMTP_PORT', '25'))
+        self.user = os.getenv('SMTP_USER')
+        self.password = os.getenv('SMTP_PASSWORD')
+        self.starttls = os.getenv('SMTP_STARTTLS', 'false').lower() == 'true'
+
+    def send(self, to_email: str, subject: str, html_content: str):
+        with smtplib.SMTP(self.host, self.port, timeout=30) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.user:
+                smtp.login(self.user, self.password)
+            smtp.send_message(_build_message(to_email, subject, html_content))
+
+
+class FileTransport:
+
+    def __init__(self):
+        self.directory = Path(os.getenv('EMAIL_FILE_DIR', 'outbox'))
+
+    def send(self, to_email: str, subject: str, html_content: str):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        message = _build_message(to_email, subject, html_content)
+        path = self.directory / f"{datetime.utcnow():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}.eml"
+        path.write_bytes(message.as_bytes())
+
+
+TRANSPORTS = {
+    'sendgrid': SendGridTransport,
+    'smtp': SmtpTransport,
+    'file': FileTransport,
+}
+
+
+def _build_message(to_email: str, subject: str, html_content: str) -> EmailMessage:
+    message = EmailMessage()
+    message['From'] = os.getenv('FROM_EMAIL', 'noreply@localhost')
+    message['To'] = to_email
+    message['Subject'] = subject
+    message.set_content(html_content, subtype='html')
+    return message
+
+
+def create_transport(kind: str = EMAIL_TRANSPORT):
+    if kind not in TRANSPORTS:
+        raise ValueError(f"Unknown email transport: {kind}")
+    return TRANSPORTS[kind]()
+
+
+# wakes the worker as soon as a message is committed instead of waiting for the next poll
+_pending: asyncio.Queue = asyncio.Queue()
+
+
+async def enqueue_email(db: AsyncSession, to_email: str, subject: str, html_content: str) -> int:
+    now = datetime.utcnow()
+    message = EmailOutbox(to_email=to_email, subject=subject, html_content=html_content, status='pending',
+                          attempts=0, next_attempt_at=now, created_at=now)
+    db.add(message)
+    await db.commit()
+    outbox_stats["enqueued"] += 1
+    _pending.put_nowait(message.id)
+    return message.id
+
+
+async def claim_batch(db: AsyncSession, limit: int = EMAIL_BATCH_SIZE) -> list[EmailOutbox]:
+    now = datetime.utcnow()
+    candidates = (await db.scalars(
+        select(EmailOutbox)
+        .where(EmailOutbox.status == 'pending', EmailOutbox.next_attempt_at <= now)
+        .order_by(EmailOutbox.next_attempt_at)
+        .limit(limit)
+    )).all()
+    claimed = []
+    for message in candidates:
+        # pushing next_attempt_at forward is the claim, only one worker can move it from the value it read
+        result = await db.execute(
+            update(EmailOutbox)
+            .where(EmailOutbox.id == message.id, EmailOutbox.status == 'pending',
+                   EmailOutbox.next_attempt_at == message.next_attempt_at)
+            .values(next_attempt_at=now + timedelta(seconds=EMAIL_CLAIM_SECONDS),
+                    attempts=EmailOutbox.attempts + 1)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 1:
+            claimed.append(message)
+    await db.commit()
+    return claimed
+
+
+async def deliver(db: AsyncSession, message: EmailOutbox, transport):
+    attempts = message.attempts + 1
+    values = {}
+    try:
+        await asyncio.to_thread(transport.send, message.to_email, message.subject, message.html_content)
+        values.update(status='sent', sent_at=datetime.utcnow(), last_error=None)
+        outbox_stats["sent"] += 1
+    except Exception as e:
+        values['last_error'] = str(e)[:500]
+        if attempts >= EMAIL_MAX_ATTEMPTS:
+            values['status'] = 'failed'
+            outbox_stats["failed"] += 1
+            logger.error(f"Giving up on email {message.id} after {attempts} attempts. Reason: {e}")
+        else:
+            delay = EMAIL_RETRY_SECONDS * 2 ** (attempts - 1)
+            values['next_attempt_at'] = datetime.utcnow() + timedelta(seconds=delay)
+            outbox_stats["retried"] += 1
+            logger.warning(f"Failed to send email {message.id}, retrying in {delay:.0f}s. Reason: {e}")
+    await db.execute(update(EmailOutbox).where(EmailOutbox.id == message.id).values(**values)
+                     .execution_options(synchronize_session=False))
+    await db.commit()
+
+
+async def drain_outbox(transport) -> int:
+    delivered = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            batch = await claim_batch(db)
+            if not batch:
+                return delivered
+            await asyncio.gather(*(_deliver_one(message, transport) for message in batch))
+            delivered += len(batch)
+
+
+async def _deliver_one(message: EmailOutbox, transport):
+    # each delivery gets its own session so a batch can be sent concurrently
+    async with AsyncSessionLocal() as db:
+        await deliver(db, message, transport)
+
+
+async def email_worker():
+    transport = create_transport()
+    while True:
+        try:
+            await drain_outbox(transport)
+        except Exception as e:
+            logger.warning(f"Failed to drain email outbox. Reason: {e}")
+        try:
+            await asyncio.wait_for(_pending.get(), timeout=EMAIL_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        while not _pending.empty():
+            _pending.get_nowait()
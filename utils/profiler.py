@@ -0,0 +1,104 @@
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import random
+import re
+import secrets
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from authorization import internal_auth_token
+
+PROFILE_DIR = Path(os.getenv('PROFILE_DIR', 'profiles'))
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))  # share of requests profiled at random
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', '20'))  # oldest profiles are deleted past this
+# a request carrying the internal token in this header is always profiled
+PROFILE_HEADER = os.getenv('PROFILE_HEADER', 'X-Profile').lower().encode()
+
+PROFILE_NAME = re.compile(r'^[\w.-]+\.prof$')
+
+# cProfile hooks the event loop thread, one profile at a time keeps the numbers readable
+_lock = asyncio.Lock()
+
+
+def _requested(scope) -> bool:
+    for name, value in scope['headers']:
+        if name == PROFILE_HEADER:
+            return internal_auth_token is not None and secrets.compare_digest(value.decode(), internal_auth_token)
+    return False
+
+
+def _profile_name(scope) -> str:
+    path = re.sub(r'[^\w]+', '_', scope['path']).strip('_') or 'root'
+    return f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:6]}-{scope['method']}-{path[:60]}.prof"
+
+
+def _save(profiler: cProfile.Profile, name: str):
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    profiler.dump_stats(PROFILE_DIR / name)
+    for stale in list_profiles()[PROFILE_MAX_FILES:]:
+        (PROFILE_DIR / stale['name']).unlink(missing_ok=True)
+
+
+def list_profiles() -> list[dict]:
+    if not PROFILE_DIR.is_dir():
+        return []
+    profiles = []
+    for path in PROFILE_DIR.glob('*.prof'):
+        stat = path.stat()
+        profiles.append({
+            'name': path.name,
+            'size': stat.st_size,
+            'created': datetime.utcfromtimestamp(stat.st_mtime),
+        })
+    return sorted(profiles, key=lambda profile: profile['name'], reverse=True)
+
+
+def profile_path(name: str) -> Optional[Path]:
+    # names come from the URL, anything that is not a plain file name in PROFILE_DIR is rejected
+    if not PROFILE_NAME.match(name):
+        return None
+    path = PROFILE_DIR / name
+    return path if path.is_file() else None
+
+
+def render_profile(path: Path, limit: int = 50) -> str:
+    out = io.StringIO()
+    stats = pstats.Stats(str(path), stream=out)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+    return out.getvalue()
+
+
+# Profiles the event loop thread while a sampled request runs. Work handed to executors
+# (bcrypt, the Monte Carlo pool) only shows up as the await, requests served concurrently
+# on the loop are included as well.
+class ProfilerMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or _lock.locked():
+            return await self.app(scope, receive, send)
+        if not _requested(scope) and not (PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE):
+            return await self.app(scope, receive, send)
+
+        async with _lock:
+            name = _profile_name(scope)
+
+            async def send_wrapper(message):
+                if message['type'] == 'http.response.start':
+                    message['headers'] = list(message.get('headers', [])) + [(b'x-profile-id', name.encode())]
+                await send(message)
+
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                profiler.disable()
+                await asyncio.to_thread(_save, profiler, name)
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import select, delete, insert
+
+from database import AsyncSessionLocal
+from models import PasswordResetCode
+
+logger = logging.getLogger(__name__)
+
+RESET_CODE_TTL = int(os.getenv('RESET_CODE_TTL_SECONDS', '900'))
+RESET_CODE_SWEEP_SECONDS = float(os.getenv('RESET_CODE_SWEEP_SECONDS', '60'))
+# memory only works with a single worker process, sql is shared by every worker
+RESET_CODE_STORE = os.getenv('RESET_CODE_STORE', 'memory')
+
+
+class ResetCodeStore(ABC):
+
+    @abstractmethod
+    async def put(self, code: str, email: str):
+        ...
+
+    @abstractmethod
+    async def pop(self, code: str) -> Optional[str]:
+        # returns the email of a live code and consumes it, None when unknown or expired
+        ...
+
+    @abstractmethod
+    async def sweep(self) -> int:
+        ...
+
+
+class InMemoryResetCodeStore(ResetCodeStore):
+
+    def __init__(self, ttl: int = RESET_CODE_TTL):
+        self.ttl = ttl
+        self._codes: dict[str, tuple[str, float]] = {}
+
+    async def put(self, code: str, email: str):
+        self._codes[code] = (email, time.monotonic() + self.ttl)
+
+    async def pop(self, code: str) -> Optional[str]:
+        entry = self._codes.pop(code, None)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    async def sweep(self) -> int:
+        now = time.monotonic()
+        expired = [code for code, (_, expires_at) in self._codes.items() if expires_at <= now]
+        for code in expired:
+            del self._codes[code]
+        return len(expired)
+
+
+class SqlResetCodeStore(ResetCodeStore):
+
+    def __init__(self, ttl: int = RESET_CODE_TTL, session_factory=AsyncSessionLocal):
+        self.ttl = ttl
+        self._session_factory = session_factory
+
+    async def put(self, code: str, email: str):
+        async with self._session_factory() as db:
+            await db.execute(insert(PasswordResetCode).values(
+                code=code, email=email, expires_at=datetime.utcnow() + timedelta(seconds=self.ttl)
+            ))
+            await db.commit()
+
+    async def pop(self, code: str) -> Optional[str]:
+        async with self._session_factory() as db:
+            email = await db.scalar(
+                select(PasswordResetCode.email)
+                .where(PasswordResetCode.code == code)
+                .where(PasswordResetCode.expires_at > datetime.utcnow())
+            )
+            if email is None:
+                return None
+            # only the request whose delete hits the row may use the code
+            result = await db.execute(delete(PasswordResetCode).where(PasswordResetCode.code == code))
+            await db.commit()
+            return email if result.rowcount == 1 else None
+
+    async def sweep(self) -> int:
+        async with self._session_factory() as db:
+            result = await db.execute(
+                delete(PasswordResetCode).where(PasswordResetCode.expires_at <= datetime.utcnow())
+            )
+            await db.commit()
+            return result.rowcount
+
+
+def create_store(kind: str = RESET_CODE_STORE) -> ResetCodeStore:
+    if kind == 'memory':
+        return InMemoryResetCodeStore()
+    if kind == 'sql':
+        return SqlResetCodeStore()
+    raise ValueError(f"Unknown reset code store: {kind}")
+
+
+reset_codes = create_store()
+
+
+async def sweep_reset_codes():
+    while True:
+        await asyncio.sleep(RESET_CODE_SWEEP_SECONDS)
+        try:
+            await reset_codes.sweep()
+        except Exception as e:
+            logger.warning(f"Failed to sweep reset codes. Reason: {e}")
@@ -0,0 +1,71 @@
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime, date
+from typing import Optional
+
+import pandas as pd
+from pandas import DataFrame
+
+from database import get_influx_client, InfluxClient, INFLUX_POOL_SIZE
+from utils.cache import KeyedLocks
+from utils.telemetry import compute_seconds, timed
+
+# history the simulator statistics are computed from
+RETURNS_RANGE = "3m"
+
+
+@dataclass
+class SymbolReturns:
+    returns: pd.Series  # daily returns in percent, indexed by day
+    mean: float
+    std: float
+    day: date  # UTC day the statistics were computed on
+
+
+def compute_daily_returns(df: DataFrame, day: date) -> SymbolReturns:
+    # only complete days, the current one would change the statistics until midnight
+    df = df[df._time.dt.date < day]
+    close = df.groupby(df._time.dt.date)["ClosePrice"].mean()
+    previous_close = close.shift(1)
+    returns = (((close - previous_close) / previous_close) * 100).dropna()
+    return SymbolReturns(returns=returns, mean=returns.mean(), std=returns.std(), day=day)
+
+
+# Daily returns only move once a day, so they are materialized per symbol and recomputed
+# from raw candles on the first access of every UTC day.
+class DailyReturnsStore:
+
+    def __init__(self):
+        self._entries: dict[str, SymbolReturns] = {}
+        self._locks = KeyedLocks()
+
+    def clear(self):
+        self._entries.clear()
+
+    async def get(self, symbols: list[str], client: Optional[InfluxClient] = None) -> dict[str, SymbolReturns]:
+        today = datetime.utcnow().date()
+        semaphore = asyncio.Semaphore(INFLUX_POOL_SIZE)
+
+        async def load(symbol: str) -> Optional[SymbolReturns]:
+            async with self._locks(symbol):
+                entry = self._entries.get(symbol)
+                if entry is not None and entry.day == today:
+                    return entry
+                async with semaphore:
+                    # outside of a request there is no injected client, a one-shot client is closed after each query
+                    symbol_client = client if client is not None else await get_influx_client()
+                    df = await symbol_client.query_data(RETURNS_RANGE, symbol)
+                if not isinstance(df, DataFrame) or df.empty:
+                    return None
+                with timed(compute_seconds, step='daily_returns'):
+                    entry = compute_daily_returns(df, today)
+                if not entry.returns.empty:
+                    self._entries[symbol] = entry
+                return entry
+
+        entries = await asyncio.gather(*(load(symbol) for symbol in symbols))
+        return {symbol: entry for symbol, entry in zip(symbols, entries)
+                if entry is not None and not entry.returns.empty}
+
+
+daily_returns = DailyReturnsStore()
@@ -0,0 +1,65 @@
+import logging
+
+from sqlalchemy import inspect, select, text, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import DBAPIError
+
+from models import Transaction, UserTransaction
+
+logger = logging.getLogger(__name__)
+
+
+def _column_names(connection: Connection, table) -> set[str]:
+    return {column['name'] for column in inspect(connection).get_columns(table.name)}
+
+
+def _index_names(connection: Connection, table) -> set[str]:
+    return {index['name'] for index in inspect(connection).get_indexes(table.name)}
+
+
+def _add_column(connection: Connection, column) -> bool:
+    # always added nullable, the dialect quotes the names (transaction is a keyword)
+    preparer = connection.dialect.identifier_preparer
+    try:
+        connection.execute(text(
+            f"ALTER TABLE {preparer.format_table(column.table)} "
+            f"ADD COLUMN {preparer.format_column(column)} {column.type.compile(dialect=connection.dialect)}"
+        ))
+    except DBAPIError:
+        # every worker upgrades on start, another one may have added it since we looked
+        if column.name in _column_names(connection, column.table):
+            return False
+        raise
+    return True
+
+
+def _create_index(connection: Connection, index):
+    try:
+        index.create(connection)
+    except DBAPIError:
+        if index.name not in _index_names(connection, index.table):
+            raise
+
+
+# create_all only creates missing tables, columns added to existing tables are brought in here.
+# Every step checks the live schema first so it is safe to run on each start, and tolerates
+# another worker doing the same step at the same time.
+def upgrade_schema(connection: Connection):
+    if 'transaction_date' not in _column_names(connection, UserTransaction.__table__):
+        # added nullable and filled in place, new databases get the NOT NULL column from the model
+        if _add_column(connection, UserTransaction.__table__.c.transaction_date):
+            logger.warning("Added user_transaction.transaction_date, backfilling from transaction")
+            connection.execute(update(UserTransaction).values(transaction_date=(
+                select(Transaction.transaction_date)
+                .where(Transaction.id == UserTransaction.transaction_id)
+                .scalar_subquery()
+            )))
+
+    if 'import_token' not in _column_names(connection, Transaction.__table__):
+        _add_column(connection, Transaction.__table__.c.import_token)
+
+    for table in (UserTransaction.__table__, Transaction.__table__):
+        existing = _index_names(connection, table)
+        for index in table.indexes:
+            if index.name not in existing:
+                _create_index(connection, index)
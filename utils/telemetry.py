@@ -0,0 +1,147 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+registry = CollectorRegistry()
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+http_request_seconds = Histogram('http_request_duration_seconds', 'Request latency by route',
+                                 ['method', 'route'], buckets=LATENCY_BUCKETS, registry=registry)
+http_requests = Counter('http_requests_total', 'Requests by route and status code',
+                        ['method', 'route', 'status'], registry=registry)
+http_in_progress = Gauge('http_requests_in_progress', 'Requests being served', registry=registry)
+
+db_statements = Histogram('db_statements_per_request', 'SQL statements executed per request', ['method', 'route'],
+                          buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100), registry=registry)
+db_request_seconds = Histogram('db_request_duration_seconds', 'Time spent in SQL per request',
+                               ['method', 'route'],
+                               buckets=LATENCY_BUCKETS, registry=registry)
+db_statement_seconds = Histogram('db_statement_duration_seconds', 'SQL statement latency',
+                                 buckets=LATENCY_BUCKETS, registry=registry)
+
+influx_query_seconds = Histogram('influx_query_duration_seconds', 'Influx query latency', ['kind'],
+                                 buckets=LATENCY_BUCKETS, registry=registry)
+influx_rows = Counter('influx_rows_total', 'Rows returned by Influx queries', ['kind'], registry=registry)
+influx_errors = Counter('influx_query_errors_total', 'Failed Influx queries', ['kind'], registry=registry)
+
+password_hash_seconds = Histogram('password_hash_duration_seconds', 'bcrypt hash and verify time including queueing',
+                                  buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10), registry=registry)
+compute_seconds = Histogram('compute_duration_seconds', 'CPU-bound post-processing by step', ['step'],
+                            buckets=LATENCY_BUCKETS, registry=registry)
+
+# [statement count, seconds] of the request being served, shared with the SQL greenlets through the context
+_request_sql: ContextVar[Optional[list]] = ContextVar('request_sql', default=None)
+
+
+@contextmanager
+def timed(histogram: Histogram, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        (histogram.labels(**labels) if labels else histogram).observe(time.perf_counter() - started)
+
+
+def instrument_engine(engine: Engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        db_statement_seconds.observe(elapsed)
+        sql = _request_sql.get()
+        if sql is not None:
+            sql[0] += 1
+            sql[1] += elapsed
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        # a failed statement never reaches after_cursor_execute, drop its start time here
+        conn = exception_context.connection
+        if conn is not None and conn.info.get('query_started'):
+            conn.info['query_started'].pop()
+
+
+class MetricsMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        status_code = 500
+        sql = [0, 0.0]
+        token = _request_sql.set(sql)
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        http_in_progress.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_in_progress.dec()
+            _request_sql.reset(token)
+            # the router fills in the matched route, unmatched paths share one label to bound cardinality
+            route = scope.get('route')
+            route = getattr(route, 'path', 'unmatched')
+            http_request_seconds.labels(scope['method'], route).observe(elapsed)
+            http_requests.labels(scope['method'], route, str(status_code)).inc()
+            db_statements.labels(scope['method'], route).observe(sql[0])
+            db_request_seconds.labels(scope['method'], route).observe(sql[1])
+
+
+class _StateCollector:
+    # pool saturation and the in-process counters also served on /stats, read at scrape time
+
+    def collect(self):
+        from authorization import hash_stats, token_cache_stats
+        from database import async_engine, candle_cache, influx_pool_usage
+        from utils.outbox import outbox_stats
+        from utils.throttle import login_stats
+
+        pool = async_engine.pool
+        if hasattr(pool, 'checkedout'):
+            yield GaugeMetricFamily('db_pool_checked_out', 'Connections in use', value=pool.checkedout())
+            yield GaugeMetricFamily('db_pool_size', 'Connections the pool keeps open', value=pool.size())
+            yield GaugeMetricFamily('db_pool_overflow', 'Connections opened past the pool size',
+                                    value=max(pool.overflow(), 0))
+
+        usage = influx_pool_usage()
+        if usage is not None:
+            yield GaugeMetricFamily('influx_pool_in_use', 'Influx connections in use', value=usage[0])
+            yield GaugeMetricFamily('influx_pool_size', 'Influx connection limit', value=usage[1])
+
+        groups = {
+            'password_hashing': hash_stats,
+            'token_cache': token_cache_stats,
+            'candle_cache': candle_cache.stats(),
+            'email_outbox': outbox_stats,
+            'login_throttle': login_stats,
+        }
+        for group, stats in groups.items():
+            for key, value in stats.items():
+                yield GaugeMetricFamily(f'backend_{group}_{key}', f'{group} {key}', value=value)
+
+
+registry.register(_StateCollector())
+
+
+def render_metrics() -> tuple[bytes, str]:
+    return generate_latest(registry), CONTENT_TYPE_LATEST
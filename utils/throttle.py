@@ -0,0 +1,108 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from fastapi import HTTPException, Request
+from starlette import status
+
+LOGIN_USER_RATE = float(os.getenv('LOGIN_USER_RATE', '5'))  # attempts per minute per username
+LOGIN_USER_BURST = int(os.getenv('LOGIN_USER_BURST', '5'))
+LOGIN_IP_RATE = float(os.getenv('LOGIN_IP_RATE', '30'))  # attempts per minute per client address
+LOGIN_IP_BURST = int(os.getenv('LOGIN_IP_BURST', '30'))
+LOGIN_MAX_INFLIGHT = int(os.getenv('LOGIN_MAX_INFLIGHT', str(2 * (os.cpu_count() or 1))))
+LOGIN_INFLIGHT_WAIT = float(os.getenv('LOGIN_INFLIGHT_WAIT', '2'))  # seconds queued for a slot before a 503
+# proxies in front of the app that append to X-Forwarded-For. With 0 the peer address is used,
+# which behind a proxy puts every user in the proxy's single IP bucket.
+TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', '0'))
+LOGIN_THROTTLE_KEYS = int(os.getenv('LOGIN_THROTTLE_KEYS', '100000'))  # buckets kept per limiter
+
+login_stats = {
+    "served": 0,
+    "throttled_user": 0,
+    "throttled_ip": 0,
+    "rejected_busy": 0,
+    "inflight": 0,
+}
+
+
+# Token bucket per key, refilled lazily on access. Least recently used buckets are dropped
+# past max_keys, a dropped bucket comes back full which only ever errs towards letting through.
+class RateLimiter:
+
+    def __init__(self, rate_per_minute: float, burst: int, max_keys: int = LOGIN_THROTTLE_KEYS):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    def acquire(self, key: str) -> Optional[float]:
+        # takes a token, returns the seconds until one is available when the bucket is empty
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        retry_after = None
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / self.rate if self.rate > 0 else math.inf
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+
+user_limiter = RateLimiter(LOGIN_USER_RATE, LOGIN_USER_BURST)
+ip_limiter = RateLimiter(LOGIN_IP_RATE, LOGIN_IP_BURST)
+_inflight = asyncio.Semaphore(LOGIN_MAX_INFLIGHT)
+
+
+def client_address(request: Request) -> str:
+    peer = request.client.host if request.client else 'unknown'
+    if TRUSTED_PROXY_HOPS <= 0:
+        return peer
+    # each trusted proxy appends the address it received from, entries further left are client supplied
+    forwarded = [part.strip() for part in request.headers.get('x-forwarded-for', '').split(',') if part.strip()]
+    if not forwarded:
+        return peer
+    return forwarded[-min(TRUSTED_PROXY_HOPS, len(forwarded))]
+
+
+def _too_many(retry_after: float):
+    raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                        detail='Too many login attempts, try again later',
+                        headers={'Retry-After': str(math.ceil(min(retry_after, 3600)))})
+
+
+def check_login(username: str, client_ip: str):
+    # runs before the user lookup so throttled attempts cost no DB round trip or bcrypt work
+    retry_after = ip_limiter.acquire(client_ip)
+    if retry_after is not None:
+        login_stats["throttled_ip"] += 1
+        _too_many(retry_after)
+    retry_after = user_limiter.acquire(username.strip().lower())
+    if retry_after is not None:
+        login_stats["throttled_user"] += 1
+        _too_many(retry_after)
+
+
+@asynccontextmanager
+async def login_slot():
+    # short bursts queue for a slot, only a backlog that outlasts LOGIN_INFLIGHT_WAIT is turned away
+    try:
+        await asyncio.wait_for(_inflight.acquire(), LOGIN_INFLIGHT_WAIT)
+    except asyncio.TimeoutError:
+        login_stats["rejected_busy"] += 1
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail='Too many concurrent logins, try again later',
+                            headers={'Retry-After': '1'})
+    login_stats["inflight"] += 1
+    try:
+        yield
+    finally:
+        login_stats["inflight"] -= 1
+        login_stats["served"] += 1
+        _inflight.release()
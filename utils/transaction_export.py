@@ -0,0 +1,58 @@
+import csv
+import io
+import json
+from typing import AsyncIterator
+
+from sqlalchemy import select
+
+from database import AsyncSessionLocal
+from models import Company, Transaction, UserTransaction
+
+EXPORT_BATCH_SIZE = 1000  # rows fetched from the server-side cursor per round trip
+EXPORT_COLUMNS = ['id', 'company_symbol', 'amount', 'price_per_unit', 'transaction_date', 'transaction_type']
+
+MEDIA_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def _export_query(user_id: int):
+    return (
+        select(Transaction.id, Company.company_symbol, Transaction.amount, Transaction.price_per_unit,
+               Transaction.transaction_date, Transaction.transaction_type)
+        .join(UserTransaction, UserTransaction.transaction_id == Transaction.id)
+        .outerjoin(Company, Company.id == Transaction.company_id)
+        .where(UserTransaction.user_id == user_id)
+        .order_by(UserTransaction.transaction_date, UserTransaction.transaction_id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+
+
+def _values(row) -> list:
+    transaction_id, symbol, amount, price_per_unit, transaction_date, transaction_type = row
+    return [transaction_id, symbol, amount, float(price_per_unit), transaction_date.isoformat(),
+            transaction_type.value if transaction_type is not None else None]
+
+
+def _csv_chunk(rows, header: bool = False) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(EXPORT_COLUMNS)
+    writer.writerows(_values(row) for row in rows)
+    return buffer.getvalue()
+
+
+def _ndjson_chunk(rows) -> str:
+    return ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, _values(row)))) + '\n' for row in rows)
+
+
+async def export_transactions(user_id: int, export_format: str) -> AsyncIterator[str]:
+    # the session belongs to the generator, it has to outlive the request handler while streaming
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(_export_query(user_id))
+        if export_format == 'csv':
+            yield _csv_chunk([], header=True)
+        async for rows in result.partitions():
+            yield _csv_chunk(rows) if export_format == 'csv' else _ndjson_chunk(rows)
@@ -1,14 +1,6 @@
+from database import AsyncSessionLocal
 
-from database import SessionLocal
 
-
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
-
-
-
-